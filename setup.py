@@ -28,13 +28,21 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'async': ['gevent'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update-xml = presence_analyzer.update_xml:update
+    import-shards = presence_analyzer.import_data:import_shards
+    generate-data = presence_analyzer.generate_data:generate
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+
+    [paste.server_runner]
+    gevent = presence_analyzer.script:serve_gevent
     """,
 )
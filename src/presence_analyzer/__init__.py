@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer.
+
+Application object is created in `main`, views are registered only by
+processes serving requests, see `main.load_views`.
 """
-from .main import app
-from . import views
-from presence_analyzer import urls
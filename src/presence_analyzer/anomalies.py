@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data anomaly detection.
+"""
+from datetime import date as date_type
+
+
+SHORT_INTERVAL = 15 * 60
+KINDS = ('malformed', 'duplicate', 'overnight', 'short', 'missing')
+
+
+class AnomalyDetector(object):
+    """
+    Collects anomalies of presence rows while they are being read.
+
+    Detected anomalies:
+    - malformed: line which could not be parsed,
+    - duplicate: another row for the same user and date,
+    - overnight: end of work before its start (negative interval),
+    - short: interval shorter than `short_interval` seconds,
+    - missing: weekday without presence between user's first and last day.
+    """
+
+    def __init__(self, short_interval=SHORT_INTERVAL):
+        self.short_interval = short_interval
+        self.anomalies = {}
+        self.malformed_lines = []
+        self.dates = {}
+
+    def add(self, user_id, kind, date=None, line=None):
+        """
+        Records single anomaly of given user.
+        """
+        self.anomalies.setdefault(user_id, []).append({
+            'type': kind,
+            'date': date.isoformat() if date is not None else None,
+            'line': line,
+        })
+
+    def check(self, line, user_id, date, start, end):
+        """
+        Checks parsed row for anomalies.
+        """
+        user_dates = self.dates.setdefault(user_id, set())
+        ordinal = date.toordinal()
+        if ordinal in user_dates:
+            self.add(user_id, 'duplicate', date, line)
+        user_dates.add(ordinal)
+
+        interval = (
+            (end.hour - start.hour) * 3600 +
+            (end.minute - start.minute) * 60 +
+            end.second - start.second
+        )
+        if interval < 0:
+            self.add(user_id, 'overnight', date, line)
+        elif interval < self.short_interval:
+            self.add(user_id, 'short', date, line)
+
+    def malformed(self, line, row):
+        """
+        Records line which could not be parsed.
+        """
+        try:
+            user_id = int(row[0])
+        except (ValueError, TypeError, IndexError):
+            self.malformed_lines.append(line)
+        else:
+            self.add(user_id, 'malformed', line=line)
+
+    def finish(self):
+        """
+        Looks for missing weekdays once all rows have been read. Can be
+        called again after more rows have been checked.
+        """
+        for user_id, ordinals in self.dates.iteritems():
+            if not ordinals:
+                continue
+            if user_id in self.anomalies:
+                self.anomalies[user_id] = [
+                    anomaly for anomaly in self.anomalies[user_id]
+                    if anomaly['type'] != 'missing'
+                ]
+                if not self.anomalies[user_id]:
+                    del self.anomalies[user_id]
+            for ordinal in xrange(min(ordinals), max(ordinals)):
+                if ordinal in ordinals:
+                    continue
+                date = date_type.fromordinal(ordinal)
+                if date.weekday() < 5:
+                    self.add(user_id, 'missing', date)
+        return self
+
+    @classmethod
+    def merge(cls, sources, short_interval=SHORT_INTERVAL):
+        """
+        Combines detectors of several data sources, given as
+        (name, detector) pairs. Anomalies are labelled with their source,
+        days present in more than one source are reported as duplicates
+        and missing weekdays are looked for in combined dates.
+        """
+        merged = cls(short_interval)
+        for name, detector in sources:
+            for user_id, anomalies in detector.anomalies.iteritems():
+                merged.anomalies.setdefault(user_id, []).extend(
+                    dict(anomaly, source=name) for anomaly in anomalies
+                    if anomaly['type'] != 'missing'
+                )
+            merged.malformed_lines.extend(detector.malformed_lines)
+            for user_id, ordinals in detector.dates.iteritems():
+                user_dates = merged.dates.setdefault(user_id, set())
+                for ordinal in sorted(ordinals & user_dates):
+                    merged.add(
+                        user_id, 'duplicate', date_type.fromordinal(ordinal)
+                    )
+                    merged.anomalies[user_id][-1]['source'] = name
+                user_dates.update(ordinals)
+        return merged.finish()
+
+    def counts(self, user_id):
+        """
+        Returns number of anomalies of given user by kind.
+        """
+        counts = dict.fromkeys(KINDS, 0)
+        for anomaly in self.anomalies.get(user_id, []):
+            counts[anomaly['type']] += 1
+        return counts
+
+    def get_user(self, user_id):
+        """
+        Returns anomaly counts and list of given user.
+        """
+        return {
+            'counts': self.counts(user_id),
+            'anomalies': self.anomalies.get(user_id, []),
+        }
+
+    def summary(self):
+        """
+        Returns company-wide anomaly counts.
+        """
+        users = {
+            user_id: self.counts(user_id) for user_id in self.anomalies
+        }
+        totals = dict.fromkeys(KINDS, 0)
+        for counts in users.itervalues():
+            for kind, count in counts.iteritems():
+                totals[kind] += count
+        totals['malformed'] += len(self.malformed_lines)
+        return {
+            'counts': totals,
+            'users': users,
+            'malformed_lines': self.malformed_lines,
+        }
+
+    def to_dict(self):
+        """
+        Returns JSON serializable representation of detected anomalies.
+        """
+        return {
+            'short_interval': self.short_interval,
+            'anomalies': {
+                str(user_id): anomalies
+                for user_id, anomalies in self.anomalies.iteritems()
+            },
+            'malformed_lines': self.malformed_lines,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Restores detector saved with to_dict().
+        """
+        detector = cls(data['short_interval'])
+        detector.anomalies = {
+            int(user_id): anomalies
+            for user_id, anomalies in data['anomalies'].iteritems()
+        }
+        detector.malformed_lines = data['malformed_lines']
+        return detector
+
+
+class StoredAnomalies(object):
+    """
+    Anomalies saved by storage import. Only counts are kept in memory,
+    anomaly list of a user is read by `read_user(user_id)` when the user
+    is requested.
+    """
+
+    def __init__(self, data, read_user):
+        self.short_interval = data['short_interval']
+        summary = data['summary']
+        self.users = {
+            int(user_id): counts
+            for user_id, counts in summary['users'].iteritems()
+        }
+        self.totals = summary['counts']
+        self.malformed_lines = summary['malformed_lines']
+        self.read_user = read_user
+
+    @staticmethod
+    def dump(detector):
+        """
+        Returns JSON serializable settings and summary of finished
+        detector, saved by storage next to per-user anomaly lists.
+        """
+        return {
+            'short_interval': detector.short_interval,
+            'summary': detector.summary(),
+        }
+
+    def counts(self, user_id):
+        """
+        Returns number of anomalies of given user by kind.
+        """
+        return dict(self.users.get(user_id) or dict.fromkeys(KINDS, 0))
+
+    def get_user(self, user_id):
+        """
+        Returns anomaly counts and list of given user.
+        """
+        return {
+            'counts': self.counts(user_id),
+            'anomalies': (
+                self.read_user(user_id) if user_id in self.users else []
+            ),
+        }
+
+    def summary(self):
+        """
+        Returns company-wide anomaly counts.
+        """
+        return {
+            'counts': dict(self.totals),
+            'users': dict(self.users),
+            'malformed_lines': list(self.malformed_lines),
+        }
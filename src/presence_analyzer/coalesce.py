@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of concurrent computations and batching of user data loads.
+"""
+import time
+from collections import Counter
+from threading import Event, Lock
+
+
+class _Flight(object):
+    """
+    Result of computation shared by all callers waiting for it.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        """
+        Publishes result (or error) to waiting callers.
+        """
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        """
+        Waits for result, re-raising error of failed computation.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RequestCoalescer(object):
+    """
+    Shares single computation between concurrent identical calls and
+    loads data of distinct users requested within `window` seconds in one
+    batched pass over storage.
+
+    Batch leader waits for more users only while other computations are
+    in flight, so requests coming one at a time are not delayed.
+    """
+
+    def __init__(self, window=0.002):
+        self.window = window
+        self.lock = Lock()
+        self.flights = {}
+        self.queue = {}
+        self.batching = False
+        self.counters = Counter()
+
+    def call(self, key, function):
+        """
+        Returns result of function, computed once for all concurrent
+        calls with equal key.
+        """
+        with self.lock:
+            self.counters['calls'] += 1
+            flight = self.flights.get(key)
+            if flight is not None:
+                leader = False
+            else:
+                leader = True
+                flight = self.flights[key] = _Flight()
+                self.counters['computations'] += 1
+        if not leader:
+            return flight.wait()
+        try:
+            result = function()
+        except Exception as error:
+            flight.finish(error=error)
+            raise
+        else:
+            flight.finish(result)
+            return result
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+    def load(self, user_id, load_many):
+        """
+        Returns data of given user, loaded together with other users
+        requested at the same time by `load_many(user_ids)` returning
+        dict of users' data.
+        """
+        with self.lock:
+            self.counters['loads'] += 1
+            pending = self.queue.get(user_id)
+            if pending is None:
+                pending = self.queue[user_id] = _Flight()
+            leader = not self.batching
+            self.batching = True
+            concurrent = len(self.flights) > 1
+        if not leader:
+            return pending.wait()
+        if self.window and concurrent:
+            time.sleep(self.window)
+        with self.lock:
+            queue, self.queue = self.queue, {}
+            self.batching = False
+            self.counters['batches'] += 1
+        try:
+            results = load_many(list(queue))
+        except Exception as error:
+            for flight in queue.itervalues():
+                flight.finish(error=error)
+            raise
+        for queued_id, flight in queue.iteritems():
+            flight.finish(results.get(queued_id, {}))
+        return pending.result
+
+    def stats(self):
+        """
+        Returns counters with coalescing ratio (calls per computation)
+        and batching ratio (user loads per storage pass).
+        """
+        with self.lock:
+            counters = dict(self.counters)
+        for name in ('calls', 'computations', 'loads', 'batches'):
+            counters.setdefault(name, 0)
+        counters['coalescing_ratio'] = (
+            float(counters['calls']) / counters['computations']
+            if counters['computations'] else 0
+        )
+        counters['batching_ratio'] = (
+            float(counters['loads']) / counters['batches']
+            if counters['batches'] else 0
+        )
+        return counters
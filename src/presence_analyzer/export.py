@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of presence data.
+
+Packed columnar layout (all integers little-endian):
+
+    magic       4 bytes, 'PRES'
+    version     uint32, currently 1
+    chunks      repeated:
+        rows        uint32, number of rows in chunk
+        user_id     int32[rows]
+        date        int32[rows], days since 1970-01-01
+        start       int32[rows], seconds since midnight
+        end         int32[rows], seconds since midnight
+    terminator  uint32 0, chunk without rows
+
+CSV export uses the same layout as the imported presence CSV file.
+"""
+import struct
+import sys
+from array import array
+from datetime import date as date_type
+
+from presence_analyzer.storage import filter_range, to_seconds
+
+
+MAGIC = 'PRES'
+VERSION = 1
+EPOCH = date_type(1970, 1, 1).toordinal()
+
+
+def iter_rows(storage, user_ids=None, date_from=None, date_to=None):
+    """
+    Yields (user_id, date, start, end) tuples of given users (all by
+    default) ordered by user and date, reading one user at a time without
+    putting them into storage cache.
+    """
+    if user_ids is None:
+        user_ids = storage.user_ids()
+    for user_id, items in storage.iter_users(user_ids):
+        items = filter_range(items, date_from, date_to)
+        for date in sorted(items):
+            yield user_id, date, items[date]['start'], items[date]['end']
+
+
+def iter_chunks(rows, chunk_rows):
+    """
+    Groups rows into lists of at most chunk_rows items.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _pack_column(values):
+    """
+    Packs integers as little-endian int32 array.
+    """
+    column = array('i', values)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tostring()
+
+
+def iter_packed(rows, chunk_rows=4096):
+    """
+    Yields presence rows encoded in packed columnar layout.
+    """
+    yield MAGIC + struct.pack('<I', VERSION)
+    for chunk in iter_chunks(rows, chunk_rows):
+        yield ''.join([
+            struct.pack('<I', len(chunk)),
+            _pack_column(row[0] for row in chunk),
+            _pack_column(row[1].toordinal() - EPOCH for row in chunk),
+            _pack_column(to_seconds(row[2]) for row in chunk),
+            _pack_column(to_seconds(row[3]) for row in chunk),
+        ])
+    yield struct.pack('<I', 0)
+
+
+def iter_csv(rows, chunk_rows=4096):
+    """
+    Yields presence rows encoded as CSV.
+    """
+    for chunk in iter_chunks(rows, chunk_rows):
+        yield ''.join(
+            '%d,%s,%s,%s\n' % (
+                user_id, date.isoformat(), start.isoformat(), end.isoformat()
+            )
+            for user_id, date, start, end in chunk
+        )
+
+
+def unpack(data):
+    """
+    Decodes packed columnar export into list of
+    (user_id, date ordinal, start, end) tuples.
+    """
+    if data[:4] != MAGIC:
+        raise ValueError('Not a packed presence export')
+    offset = 8
+    rows = []
+    while True:
+        count = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        if not count:
+            return rows
+        columns = []
+        for _ in range(4):
+            column = array('i')
+            column.fromstring(data[offset:offset + 4 * count])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += 4 * count
+        rows.extend(
+            (user_id, EPOCH + date, start, end)
+            for user_id, date, start, end in zip(*columns)
+        )
@@ -0,0 +1,226 @@
+"""
+Generator of synthetic presence CSV files and matching users XML files
+for scale testing. Output is streamed, so memory usage does not depend
+on the number of generated rows, and it is fully determined by the seed.
+"""
+import argparse
+import logging
+import random
+import sys
+from datetime import datetime, date as date_type
+from xml.sax.saxutils import escape
+
+
+DAY = 24 * 3600
+HEADER = 'Presence report\n'
+FOOTER = 'Total rows: %d\n'
+
+DISTRIBUTIONS = {
+    'normal': lambda rng, mean, spread: rng.gauss(mean, spread),
+    'uniform': lambda rng, mean, spread: rng.uniform(
+        mean - spread, mean + spread
+    ),
+    'triangular': lambda rng, mean, spread: rng.triangular(
+        mean - spread, mean + spread, mean
+    ),
+    # mostly on time, with long tail of late arrivals
+    'exponential': lambda rng, mean, spread: (
+        mean - spread + rng.expovariate(1.0 / spread) if spread else mean
+    ),
+}
+
+# ways of damaging (user_id, date, start, end) fields of a line
+CORRUPTIONS = (
+    lambda fields: [fields[0], fields[1][:-2] + 'XX', fields[2], fields[3]],
+    lambda fields: fields[:3],
+    lambda fields: [fields[0], fields[1], fields[2].replace(':', 'h', 1),
+                    fields[3]],
+    lambda fields: ['X' + fields[0]] + fields[1:],
+)
+
+FIRST_NAMES = (
+    'Adam', 'Agata', 'Agnieszka', 'Andrzej', 'Anna', 'Bartosz', 'Beata',
+    'Dariusz', 'Ewa', 'Grzegorz', 'Jakub', 'Joanna', 'Kamil', 'Katarzyna',
+    'Krzysztof', 'Magdalena', 'Marcin', 'Monika', 'Piotr', 'Tomasz',
+)
+
+
+def format_time(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def iter_rows(rng, user_ids, date_from, date_to, arrival='normal',
+              arrival_mean=9 * 3600, arrival_spread=45 * 60,
+              duration_mean=8 * 3600, duration_spread=60 * 60,
+              absence_rate=0.05, weekend_rate=0.01):
+    """
+    Yields (user_id, date, start, end) tuples, start and end in seconds
+    since midnight, ordered by user and date like the real export.
+
+    Every user gets personal shift of arrival time, then arrivals of
+    every day are drawn from given distribution.
+    """
+    arrive = DISTRIBUTIONS[arrival]
+    for user_id in user_ids:
+        shift = rng.gauss(0, arrival_spread / 2.0)
+        for ordinal in xrange(date_from.toordinal(), date_to.toordinal() + 1):
+            date = date_type.fromordinal(ordinal)
+            if date.weekday() >= 5:
+                present = rng.random() < weekend_rate
+            else:
+                present = rng.random() >= absence_rate
+            if not present:
+                continue
+            start = int(arrive(rng, arrival_mean + shift, arrival_spread))
+            start = min(max(start, 0), DAY - 1)
+            duration = int(rng.gauss(duration_mean, duration_spread))
+            end = min(start + max(duration, 0), DAY - 1)
+            yield user_id, date, start, end
+
+
+def iter_lines(rng, rows, malformed_rate=0.001, header=True):
+    """
+    Yields rows formatted as CSV lines, a fraction of them damaged,
+    between header and footer lines if they are requested.
+    """
+    if header:
+        yield HEADER
+    count = 0
+    for user_id, date, start, end in rows:
+        fields = [
+            str(user_id), date.isoformat(),
+            format_time(start), format_time(end),
+        ]
+        if malformed_rate and rng.random() < malformed_rate:
+            fields = rng.choice(CORRUPTIONS)(fields)
+        yield ','.join(fields) + '\n'
+        count += 1
+    if header:
+        yield FOOTER % count
+
+
+def iter_users_xml(rng, user_ids, host='intranet.stxnext.pl', port=443,
+                   protocol='https'):
+    """
+    Yields lines of users XML file in the intranet format.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+    yield (
+        '    <server>\n        <host>%s</host>\n        <port>%d</port>\n'
+        '        <protocol>%s</protocol>\n    </server>\n'
+    ) % (escape(host), port, escape(protocol))
+    yield '    <users>\n'
+    for user_id in user_ids:
+        name = '%s %s.' % (
+            rng.choice(FIRST_NAMES), chr(ord('A') + rng.randrange(26))
+        )
+        yield (
+            '        <user id="%d">\n'
+            '            <avatar>/api/images/users/%d</avatar>\n'
+            '            <name>%s</name>\n'
+            '        </user>\n'
+        ) % (user_id, user_id, escape(name))
+    yield '    </users>\n</intranet>\n'
+
+
+def write_lines(path, lines):
+    """
+    Writes lines to given file, or to standard output if path is '-'.
+    """
+    if path == '-':
+        sys.stdout.writelines(lines)
+        return
+    with open(path, 'w') as output:
+        output.writelines(lines)
+
+
+def parse_clock(value):
+    """
+    Parses HH:MM into amount of seconds since midnight.
+    """
+    moment = datetime.strptime(value, '%H:%M')
+    return moment.hour * 3600 + moment.minute * 60
+
+
+def parse_date(value):
+    """
+    Parses YYYY-MM-DD date.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def get_parser():
+    """
+    Returns parser of command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic presence data for scale testing.'
+    )
+    parser.add_argument('-o', '--output', default='-',
+                        help='presence CSV file, standard output by default')
+    parser.add_argument('--xml', help='matching users XML file')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--first-id', type=int, default=10)
+    parser.add_argument('--start', type=parse_date,
+                        default=date_type(2011, 1, 1))
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--arrival', choices=sorted(DISTRIBUTIONS),
+                        default='normal')
+    parser.add_argument('--arrival-mean', type=parse_clock, default='9:00',
+                        help='HH:MM')
+    parser.add_argument('--arrival-spread', type=int, default=45,
+                        help='minutes')
+    parser.add_argument('--duration-mean', type=parse_clock, default='8:00',
+                        help='HH:MM')
+    parser.add_argument('--duration-spread', type=int, default=60,
+                        help='minutes')
+    parser.add_argument('--absence-rate', type=float, default=0.05,
+                        help='fraction of weekdays without presence')
+    parser.add_argument('--weekend-rate', type=float, default=0.01,
+                        help='fraction of weekend days with presence')
+    parser.add_argument('--malformed-rate', type=float, default=0.001,
+                        help='fraction of damaged lines')
+    parser.add_argument('--no-header', dest='header', action='store_false',
+                        help='skip header and footer lines')
+    return parser
+
+
+def generate(argv=None):
+    """
+    Generates presence CSV file and, optionally, users XML file.
+    """
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger(__name__)
+    args = get_parser().parse_args(argv)
+    user_ids = xrange(args.first_id, args.first_id + args.users)
+    date_to = date_type.fromordinal(
+        args.start.toordinal() + int(round(365.25 * args.years)) - 1
+    )
+    rng = random.Random(args.seed)
+    rows = iter_rows(
+        rng, user_ids, args.start, date_to,
+        arrival=args.arrival,
+        arrival_mean=args.arrival_mean,
+        arrival_spread=args.arrival_spread * 60,
+        duration_mean=args.duration_mean,
+        duration_spread=args.duration_spread * 60,
+        absence_rate=args.absence_rate,
+        weekend_rate=args.weekend_rate,
+    )
+    write_lines(args.output, iter_lines(
+        rng, rows, malformed_rate=args.malformed_rate, header=args.header
+    ))
+    if args.xml:
+        # separate generator, so users do not depend on presence options
+        write_lines(
+            args.xml, iter_users_xml(random.Random(args.seed), user_ids)
+        )
+    log.info(
+        'Generated presence of %d users from %s to %s',
+        args.users, args.start, date_to
+    )
@@ -2,3 +2,104 @@
 """
 Helper functions used in templates.
 """
+import gzip
+import hashlib
+import logging
+import os
+
+from flask import url_for
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import memorize
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt')
+
+
+def fingerprint(filename, digest):
+    """
+    Inserts content hash before file extension: js/app.js -> js/app.<hash>.js
+    """
+    base, extension = os.path.splitext(filename)
+    return '%s.%s%s' % (base, digest[:12], extension)
+
+
+def iter_static_files(folder):
+    """
+    Yields paths of static files relative to given folder, skipping
+    compressed variants.
+    """
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith('.gz'):
+                continue
+            yield os.path.relpath(
+                os.path.join(root, name), folder
+            ).replace(os.sep, '/')
+
+
+@memorize(0)
+def get_asset_manifest():
+    """
+    Returns mapping of static file names to their fingerprinted names.
+    Static files are not expected to change while application is running.
+    """
+    manifest = {}
+    for filename in iter_static_files(app.static_folder):
+        with open(os.path.join(app.static_folder, filename), 'rb') as asset:
+            digest = hashlib.md5(asset.read()).hexdigest()
+        manifest[filename] = fingerprint(filename, digest)
+    return manifest
+
+
+@memorize(0)
+def get_asset_sources():
+    """
+    Returns mapping of fingerprinted names to static file names.
+    """
+    return {
+        fingerprinted: filename
+        for filename, fingerprinted in get_asset_manifest().iteritems()
+    }
+
+
+def static_url(filename):
+    """
+    Returns URL of static file which changes together with file content,
+    so it can be cached by browsers forever.
+    """
+    fingerprinted = get_asset_manifest().get(filename)
+    if fingerprinted is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=fingerprinted)
+
+
+def build_assets(folder):
+    """
+    Writes gzipped variants of compressible static files next to them.
+    """
+    for filename in iter_static_files(folder):
+        if not filename.endswith(COMPRESSIBLE):
+            continue
+        path = os.path.join(folder, filename)
+        compressed = path + '.gz'
+        if (os.path.exists(compressed) and
+                os.path.getmtime(compressed) >= os.path.getmtime(path)):
+            continue
+        with open(path, 'rb') as source:
+            content = source.read()
+        output = gzip.GzipFile(compressed, 'wb', 9)
+        try:
+            output.write(content)
+        finally:
+            output.close()
+        log.info('Compressed %s', filename)
+
+
+@app.context_processor
+def template_helpers():
+    """
+    Makes helpers available in templates.
+    """
+    return {'static_url': static_url}
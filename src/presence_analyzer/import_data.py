@@ -0,0 +1,32 @@
+"""
+Import script partitioning presence CSV file into per-user shards.
+Shards are rebuilt only if CSV file changed since the last import.
+"""
+import os
+import logging
+
+from presence_analyzer.main import app
+from presence_analyzer.anomalies import SHORT_INTERVAL
+from presence_analyzer.storage import ShardedStorage
+
+
+def import_shards():
+    """
+    Splits DATA_CSV into shard files stored in SHARDS_DIR.
+    """
+    app.config.from_pyfile(
+        os.path.abspath(os.path.join('parts', 'etc', 'deploy.cfg'))
+    )
+    log = logging.getLogger(__name__)
+    storage = ShardedStorage(
+        app.config['SHARDS_DIR'],
+        csv_path=app.config['DATA_CSV'],
+        shard_size=app.config.get('SHARD_SIZE', 1),
+        short_interval=app.config.get(
+            'ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL
+        ),
+    )
+    log.info(
+        'Imported %d users into %s',
+        len(storage.index['users']), storage.shards_dir
+    )
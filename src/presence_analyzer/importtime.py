@@ -0,0 +1,140 @@
+"""
+Startup benchmark: import time report in the format of `-X importtime`
+option of newer Pythons, and wall time of starting processes which
+import given modules.
+"""
+import __builtin__
+import os
+import subprocess
+import sys
+import time
+
+
+HEADER = 'import time: self [us] | cumulative | imported package'
+TARGETS = (
+    # bin/flask-ctl and console scripts
+    'presence_analyzer.script',
+    # application object, e.g. for import-shards
+    'presence_analyzer.main',
+    # serving process with all views registered
+    'presence_analyzer.urls',
+)
+
+
+def _imported_name(name, new, globals_=None, locals_=None, fromlist=None,
+                   level=-1):
+    """
+    Returns name of module imported by __import__ call which has loaded
+    given new modules, resolving relative imports.
+    """
+    # pylint: disable=unused-argument
+    package = (globals_ or {}).get('__package__') or (
+        (globals_ or {}).get('__name__', '').rpartition('.')[0]
+    )
+    candidates = [name]
+    if package:
+        if name:
+            candidates.insert(0, '%s.%s' % (package, name))
+        candidates.extend(
+            '%s.%s' % (package, item) for item in fromlist or ()
+        )
+    for candidate in candidates:
+        if candidate in new:
+            return candidate
+    return min(new, key=len)
+
+
+def trace(module, output=sys.stderr):
+    """
+    Imports given module, reporting time spent on importing every module
+    loaded on the way, children before their parents.
+    """
+    original_import = __builtin__.__import__
+    children = [0]
+    report = []
+
+    def traced_import(name, *args, **kwargs):
+        """
+        Measures import of modules not loaded yet.
+        """
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+        loaded = set(sys.modules)
+        depth = len(children)
+        children.append(0)
+        started = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            cumulative = int((time.time() - started) * 1e6)
+            nested = children.pop()
+            children[-1] += cumulative
+            new = [
+                loaded_name for loaded_name, loaded_module
+                in sys.modules.items()
+                if loaded_module is not None and loaded_name not in loaded
+            ]
+            if new:
+                report.append((
+                    cumulative - nested, cumulative,
+                    '  ' * (depth - 1) + _imported_name(name, new, *args)
+                ))
+
+    __builtin__.__import__ = traced_import
+    try:
+        __import__(module)
+    finally:
+        __builtin__.__import__ = original_import
+    output.write(HEADER + '\n')
+    for self_time, cumulative, name in report:
+        output.write(
+            'import time: %9d | %10d | %s\n' % (self_time, cumulative, name)
+        )
+    return report
+
+
+def _run_python(code):
+    """
+    Runs code in fresh Python process with the same module search path.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+
+
+def trace_process(module):
+    """
+    Reports import times of given module imported by fresh process.
+    """
+    _run_python(
+        'from presence_analyzer.importtime import trace; trace(%r)' % module
+    )
+
+
+def startup_time(module, repeat=5):
+    """
+    Returns wall times (in seconds) of starting fresh Python process which
+    imports given module, best first.
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.time()
+        _run_python('import %s' % module)
+        times.append(time.time() - started)
+    return sorted(times)
+
+
+def benchmark(modules=TARGETS, repeat=5, output=sys.stdout):
+    """
+    Reports best and median startup time of processes importing given
+    modules.
+    """
+    output.write('%-30s %10s %10s\n' % ('module', 'best [ms]', 'median'))
+    results = {}
+    for module in modules:
+        times = startup_time(module, repeat)
+        results[module] = times
+        output.write('%-30s %10.1f %10.1f\n' % (
+            module, times[0] * 1000, times[len(times) // 2] * 1000
+        ))
+    return results
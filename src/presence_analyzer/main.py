@@ -2,9 +2,20 @@
 """
 Flask app initialization.
 """
+from importlib import import_module
+
 from flask import Flask
-from flask.ext.mako import MakoTemplates
 
 
 app = Flask(__name__)  # pylint: disable=invalid-name
-mako = MakoTemplates(app)
+
+
+def load_views():
+    """
+    Registers views and returns the application.
+
+    Views pull in templates and XML parser, so they are imported only by
+    processes which serve requests, not by command line tools.
+    """
+    import_module('presence_analyzer.urls')
+    return app
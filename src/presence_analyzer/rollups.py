@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed weekly, monthly and yearly presence rollups.
+"""
+import calendar
+
+from presence_analyzer.storage import to_seconds
+
+
+PERIODS = {
+    'week': lambda date: date.isocalendar()[:2],
+    'month': lambda date: (date.year, date.month),
+    'year': lambda date: (date.year,),
+}
+LABELS = {
+    'week': '%04d-W%02d',
+    'month': '%04d-%02d',
+    'year': '%04d',
+}
+
+
+def add_to_buckets(buckets, granularity, date, start, end, sign=1):
+    """
+    Adds (or with negative sign subtracts) single day to its period bucket.
+
+    Every bucket holds [total seconds, days, sum of starts, sum of ends].
+    Changed bucket is replaced with a new list, so copies of buckets
+    dict do not share changes.
+    """
+    start, end = to_seconds(start), to_seconds(end)
+    period = PERIODS[granularity](date)
+    total, days, starts, ends = buckets.get(period, (0, 0, 0, 0))
+    if days + sign:
+        buckets[period] = [
+            total + sign * (end - start), days + sign,
+            starts + sign * start, ends + sign * end,
+        ]
+    else:
+        del buckets[period]
+
+
+def user_buckets(items, granularity):
+    """
+    Returns period buckets of single user's presence entries.
+    """
+    buckets = {}
+    for date, times in items.iteritems():
+        add_to_buckets(
+            buckets, granularity, date, times['start'], times['end']
+        )
+    return buckets
+
+
+class Rollups(object):
+    """
+    Materialized presence totals, day counts and start/end sums for every
+    week, month and year, for the whole company and, unless `per_user`
+    is false, per user.
+
+    Buckets are not changed once built: apply() returns new rollups.
+    """
+
+    def __init__(self, per_user=True):
+        self.per_user = per_user
+        self.users = {}
+        self.company = {granularity: {} for granularity in PERIODS}
+
+    @classmethod
+    def build(cls, storage, per_user=True):
+        """
+        Builds rollups of all users kept in storage, one user at a time.
+        """
+        rollups = cls(per_user)
+        for user_id in storage.user_ids():
+            for date, times in storage.get_user(user_id).iteritems():
+                rollups.add(user_id, date, times['start'], times['end'])
+        return rollups
+
+    def add(self, user_id, date, start, end, previous=None):
+        """
+        Adds presence day, replacing previous entry of the same day if
+        it is given. Without start and end previous entry is only removed.
+        """
+        targets = [self.company]
+        if self.per_user:
+            user = self.users.setdefault(
+                user_id, {granularity: {} for granularity in PERIODS}
+            )
+            targets.append(user)
+        for granularity in PERIODS:
+            for target in targets:
+                buckets = target[granularity]
+                if previous is not None:
+                    add_to_buckets(
+                        buckets, granularity, date,
+                        previous['start'], previous['end'], sign=-1
+                    )
+                if start is not None:
+                    add_to_buckets(buckets, granularity, date, start, end)
+        if self.per_user and not user['year']:
+            del self.users[user_id]
+
+    def apply(self, rows):
+        """
+        Returns new rollups with (user_id, date, start, end, previous)
+        rows added. Buckets of the company and of users having rows are
+        copied, others are shared with these rollups.
+        """
+        rollups = Rollups(self.per_user)
+        rollups.company = {
+            granularity: dict(buckets)
+            for granularity, buckets in self.company.iteritems()
+        }
+        rollups.users = dict(self.users)
+        copied = set()
+        for row in rows:
+            user_id = row[0]
+            if user_id not in copied and user_id in self.users:
+                rollups.users[user_id] = {
+                    granularity: dict(buckets)
+                    for granularity, buckets
+                    in self.users[user_id].iteritems()
+                }
+            copied.add(user_id)
+            rollups.add(*row)
+        return rollups
+
+    def get_user(self, user_id, granularity):
+        """
+        Returns period buckets of given user, None if user is unknown.
+        """
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        return user[granularity]
+
+    def get_company(self, granularity):
+        """
+        Returns period buckets of the whole company.
+        """
+        return self.company[granularity]
+
+
+def rollup_table(buckets, granularity):
+    """
+    Returns period buckets as table compatible with google charts api.
+
+    Structure sample:
+    [
+        ["Period", "Presence (s)", "Days", "Start", "End"],
+        ["2013-09", 78217, 3, 36421, 61826],
+        ...
+    ]
+    """
+    result = [['Period', 'Presence (s)', 'Days', 'Start', 'End']]
+    for period in sorted(buckets):
+        total, days, starts, ends = buckets[period]
+        result.append([
+            LABELS[granularity] % period, total, days,
+            starts // days, ends // days
+        ])
+    return result
+
+
+def monthly_hours_table(buckets):
+    """
+    Returns hours worked in each month of every year from monthly
+    buckets, compatible with google charts api.
+
+    Structure sample:
+    [
+        ["Year", "2011", "2012", "2013"],
+        ["Jan", 0, 197, 139],
+        ["Feb", 0, 149, 167],
+        ...
+        ["Dec", 142, 149, 0]
+    ]
+    """
+    years = sorted(set(year for year, _ in buckets))
+    output = [['Year'] + map(str, years)]
+    for month in range(1, 13):
+        item = [calendar.month_abbr[month]]
+        for year in years:
+            bucket = buckets.get((year, month))
+            item.append(bucket[0] / 60 ** 2 if bucket else 0)
+        output.append(item)
+    return output
@@ -6,14 +6,13 @@ import os
 import sys
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
 DEPLOY_CFG = etc('deploy.cfg')
 
+ASYNC_INI = etc('async.ini')
+
 DEBUG_INI = etc('debug.ini')
 DEBUG_CFG = etc('debug.cfg')
 
@@ -27,9 +26,18 @@ del _buildout_path
 
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+    from presence_analyzer.main import load_views
+    from presence_analyzer.utils import get_watcher, warm_up
+    app = load_views()
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('WARMUP', True):
+        # warm up on startup (first version) and after every reload
+        get_watcher().listeners.append(warm_up)
+    if app.config.get('WATCH_DATA', True):
+        get_watcher().start()
+    elif app.config.get('WARMUP', True):
+        warm_up()
     return app
 
 
@@ -40,6 +48,39 @@ def make_debug(global_conf={}, **conf):
     return DebuggedApplication(app, evalex=True)
 
 
+# bin/paster serve parts/etc/async.ini
+def serve_gevent(wsgi_app, global_conf={}, host='0.0.0.0', port=8080,
+                 connections=10000):
+    """Serve WSGI application on gevent event loop.
+
+    Every connection is handled by a greenlet instead of a thread, while
+    presence data reloads run in gevent's thread pool, so that they do not
+    block the event loop.
+
+    Standard library has to be monkey patched before the application is
+    loaded (bin/flask-ctl async does it), otherwise a real lock held by a
+    reload in the thread pool would block the whole event loop.
+    """
+    from gevent import get_hub, monkey
+    if not monkey.is_module_patched('threading'):
+        raise RuntimeError(
+            'Threading is not patched by gevent, '
+            'serve with bin/flask-ctl async.'
+        )
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from presence_analyzer.main import app
+
+    threadpool = get_hub().threadpool
+    app.extensions['reload_executor'] = (
+        lambda function, *args: threadpool.apply(function, args)
+    )
+    server = WSGIServer(
+        (host, int(port)), wsgi_app, spawn=Pool(int(connections))
+    )
+    server.serve_forever()
+
+
 # bin/flask-ctl shell
 def make_shell():
     """Interactive Flask Shell"""
@@ -50,17 +91,21 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, async_mode=False):
+    """Build paster command from 'action', 'debug' and 'async_mode' flags."""
     if debug:
         config = DEBUG_INI
+    elif async_mode:
+        config = ASYNC_INI
     else:
         config = DEPLOY_INI
     argv = ['bin/paster', 'serve', config]
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
-        argv += ['--reload']
+        # reloader restarts paster in a new process, not patched by gevent
+        if not async_mode:
+            argv += ['--reload']
     else:
         argv += [action]
     # Print the 'paster' command
@@ -75,11 +120,14 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    # application and its views are imported only by actions using them
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -95,11 +143,59 @@ def run():
         """
         _serve(action, debug=False, dry_run=dry_run)
 
+    # bin/flask-ctl async [fg|start|stop|restart|status]
+    def action_async(action=('a', 'start'), dry_run=False):
+        """Serve the application on gevent event loop.
+
+        Suited for large numbers of concurrent, mostly cached requests.
+        Requires gevent (presence_analyzer[async]). Standard library is
+        patched by gevent in this process, so code changes are not
+        reloaded in foreground mode.
+
+        Options:
+         - 'action' is one of [fg|start|stop|restart|status]
+         - '--dry-run' print the paster command and exit
+        """
+        if not dry_run and action not in ('stop', 'status'):
+            try:
+                from gevent import monkey
+            except ImportError:
+                print 'gevent is required to serve in async mode.'
+                return
+            monkey.patch_all()
+        _serve(action, dry_run=dry_run, async_mode=True)
+
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl assets
+    def action_assets():
+        """Build gzipped variants of static files."""
+        from presence_analyzer.helpers import build_assets
+        from presence_analyzer.main import app
+        build_assets(app.static_folder)
+
+    # bin/flask-ctl importtime [module]
+    def action_importtime(module=('m', ''), repeat=5):
+        """Report startup time.
+
+        Without module, reports wall time of starting processes which
+        import flask-ctl, the application and the application with views.
+        With module, reports time spent on importing every module it
+        loads, in the format of 'python -X importtime'.
+
+        Options:
+         - 'module' module to trace
+         - '--repeat' number of started processes per module
+        """
+        from presence_analyzer import importtime
+        if module:
+            importtime.trace_process(module)
+        else:
+            importtime.benchmark(repeat=repeat)
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
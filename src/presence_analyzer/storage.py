@@ -0,0 +1,1394 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data storage backends.
+"""
+import csv
+import glob
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import shutil
+import sqlite3
+from array import array
+from collections import OrderedDict
+from datetime import datetime, date as date_type, time as time_type
+from multiprocessing import Pool
+from threading import Lock
+
+from presence_analyzer.anomalies import (
+    AnomalyDetector, StoredAnomalies, SHORT_INTERVAL
+)
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+# users read by single query, below SQLite limit of query parameters
+SQLITE_BATCH = 500
+
+
+def parse_lines(lines, detector=None, first_line=0):
+    """
+    Yields (user_id, date, start, end) tuples read from presence CSV lines.
+
+    Header, footer and malformed lines are skipped. If anomaly detector
+    is given, every row is checked by it while being read.
+    """
+    presence_reader = csv.reader(lines, delimiter=',')
+    for i, row in enumerate(presence_reader, first_line):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            if detector is not None:
+                detector.malformed(i + 1, row)
+            continue
+
+        if detector is not None:
+            detector.check(i + 1, user_id, date, start, end)
+        yield user_id, date, start, end
+
+
+def parse_csv(path, detector=None):
+    """
+    Yields (user_id, date, start, end) tuples read from presence CSV file.
+    """
+    with open(path, 'r') as csvfile:
+        for row in parse_lines(csvfile, detector):
+            yield row
+
+
+def to_seconds(time):
+    """
+    Converts datetime.time object to amount of seconds since midnight.
+    """
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def from_seconds(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return time_type(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def source_signature(path):
+    """
+    Returns string identifying current version of given file.
+    """
+    stat = os.stat(path)
+    return '%s:%d:%d' % (path, stat.st_mtime, stat.st_size)
+
+
+def resolve_sources(patterns):
+    """
+    Returns existing files given as paths or glob patterns, in order of
+    patterns (files matched by a pattern are sorted by name).
+    """
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        elif os.path.isfile(pattern):
+            matches = [pattern]
+        else:
+            log.warning('Presence data source %s does not exist', pattern)
+            matches = []
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _presence_length(times):
+    """
+    Returns length of presence entry in seconds.
+    """
+    return to_seconds(times['end']) - to_seconds(times['start'])
+
+
+CONFLICT_POLICIES = {
+    # source listed later wins
+    'last': lambda kept, times: times,
+    # source listed earlier wins
+    'first': lambda kept, times: kept,
+    # longer presence wins, earlier source on ties
+    'longest': lambda kept, times: (
+        times if _presence_length(times) > _presence_length(kept) else kept
+    ),
+    # earliest start and latest end of all sources
+    'union': lambda kept, times: {
+        'start': min(kept['start'], times['start']),
+        'end': max(kept['end'], times['end']),
+    },
+}
+
+
+def _iter_sorted(index, data):
+    """
+    Yields (user_id, date, index, times) tuples of presence data sorted
+    by user and date.
+    """
+    for user_id in sorted(data):
+        items = data[user_id]
+        for date in sorted(items):
+            yield user_id, date, index, items[date]
+
+
+def merge_sources(sources, policy='last'):
+    """
+    Streaming k-way merge of presence data of several sources ordered by
+    priority. Yields (user_id, date, times) tuples sorted by user and date,
+    days present in more than one source resolved by conflict policy.
+    """
+    resolve = CONFLICT_POLICIES[policy]
+    key, kept = None, None
+    for user_id, date, _, times in heapq.merge(*[
+            _iter_sorted(index, data)
+            for index, data in enumerate(sources)]):
+        if (user_id, date) == key:
+            kept = resolve(kept, times)
+            continue
+        if key is not None:
+            yield key[0], key[1], kept
+        key, kept = (user_id, date), times
+    if key is not None:
+        yield key[0], key[1], kept
+
+
+def decode_rows(rows):
+    """
+    Decodes array of int32 quadruples (user_id, date ordinal, start, end)
+    into a dict of users' presence entries.
+    """
+    data = {}
+    for i in xrange(0, len(rows), 4):
+        data.setdefault(rows[i], {})[date_type.fromordinal(rows[i + 1])] = {
+            'start': from_seconds(rows[i + 2]),
+            'end': from_seconds(rows[i + 3]),
+        }
+    return data
+
+
+def _file_digest(path, size):
+    """
+    Returns MD5 of first size bytes of given file, None if it is shorter.
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as csvfile:
+        remaining = size
+        while remaining:
+            block = csvfile.read(min(remaining, 1 << 20))
+            if not block:
+                return None
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def in_range(date, date_from=None, date_to=None):
+    """
+    Checks if date fits in given (inclusive) range.
+    """
+    if date_from is not None and date < date_from:
+        return False
+    if date_to is not None and date > date_to:
+        return False
+    return True
+
+
+def filter_range(items, date_from=None, date_to=None):
+    """
+    Limits user's presence entries to given date range.
+    """
+    if date_from is None and date_to is None:
+        return items
+    return {
+        date: times for date, times in items.iteritems()
+        if in_range(date, date_from, date_to)
+    }
+
+
+class CSVStorage(object):
+    """
+    Keeps whole presence data read from CSV file in memory.
+    """
+    in_memory = True
+
+    def __init__(self, path, short_interval=SHORT_INTERVAL, load=True):
+        self.path = path
+        self.data = {}
+        self.anomalies = AnomalyDetector(short_interval)
+        self.offset = 0
+        self.lines = 0
+        self.digest = hashlib.md5()
+        self.complete = True
+        self.mtime = None
+        if load:
+            self.load()
+
+    def load(self, appended=None):
+        """
+        Reads rows from CSV file past already loaded part. If list is
+        given, (user_id, date, start, end, previous) tuples are added to it,
+        previous being replaced entry of the same day (or None).
+
+        Entries of users having new rows are copied, not changed in place,
+        so data already returned to readers stays consistent.
+        """
+        updated = {}
+        with open(self.path, 'rb') as csvfile:
+            # taken before reading, rows appended meanwhile change it
+            self.mtime = os.fstat(csvfile.fileno()).st_mtime
+            csvfile.seek(self.offset)
+            for user_id, date, start, end in parse_lines(
+                    self._read_lines(csvfile), self.anomalies, self.lines):
+                items = updated.get(user_id)
+                if items is None:
+                    items = updated[user_id] = dict(
+                        self.data.get(user_id, {})
+                    )
+                if appended is not None:
+                    appended.append(
+                        (user_id, date, start, end, items.get(date))
+                    )
+                items[date] = {'start': start, 'end': end}
+        if updated:
+            data = dict(self.data)
+            data.update(updated)
+            self.data = data
+        self.anomalies.finish()
+
+    def _read_lines(self, csvfile):
+        """
+        Yields lines of CSV file one at a time, checksumming them and
+        advancing loaded offset.
+        """
+        for line in csvfile:
+            self.digest.update(line)
+            self.offset += len(line)
+            self.lines += 1
+            self.complete = line.endswith('\n')
+            yield line
+
+    def refresh(self):
+        """
+        Reads rows appended to CSV file since it was loaded.
+
+        Returns list of appended (user_id, date, start, end, previous)
+        tuples, or None if the file has been rewritten and has to be
+        loaded from scratch. Already loaded part is checksummed, not parsed,
+        and only if the file has changed since it was loaded.
+        """
+        stat = os.stat(self.path)
+        if (stat.st_mtime, stat.st_size) == (self.mtime, self.offset):
+            return []
+        if not self.complete or stat.st_size < self.offset:
+            return None
+        digest = _file_digest(self.path, self.offset)
+        if digest is None or digest.digest() != self.digest.digest():
+            return None
+        appended = []
+        self.load(appended)
+        return appended
+
+    def pack(self):
+        """
+        Returns picklable state of loaded storage, presence entries packed
+        as native int32 quadruples (user_id, date ordinal, start, end).
+        """
+        rows = array('i')
+        for user_id, items in self.data.iteritems():
+            for date, times in items.iteritems():
+                rows.extend((
+                    user_id, date.toordinal(),
+                    to_seconds(times['start']), to_seconds(times['end']),
+                ))
+        return {
+            'path': self.path,
+            'rows': rows.tostring(),
+            'anomalies': self.anomalies.to_dict(),
+            'offset': self.offset,
+            'lines': self.lines,
+            'complete': self.complete,
+            'mtime': self.mtime,
+        }
+
+    @classmethod
+    def unpack(cls, state):
+        """
+        Restores storage from state returned by pack().
+        """
+        storage = cls(
+            state['path'], state['anomalies']['short_interval'], load=False
+        )
+        rows = array('i')
+        rows.fromstring(state['rows'])
+        storage.data = decode_rows(rows)
+        storage.anomalies = AnomalyDetector.from_dict(state['anomalies'])
+        storage.anomalies.dates = {
+            user_id: set(date.toordinal() for date in items)
+            for user_id, items in storage.data.iteritems()
+        }
+        storage.offset = state['offset']
+        storage.lines = state['lines']
+        storage.complete = state['complete']
+        storage.mtime = state['mtime']
+        storage.digest = _file_digest(storage.path, storage.offset)
+        if storage.digest is None:
+            # file shrank since it was parsed, next refresh reloads it
+            storage.digest = hashlib.md5()
+            storage.complete = False
+        return storage
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage using application config. Several CSV sources
+        configured in DATA_CSV_SOURCES are merged by MultiCSVStorage.
+        """
+        if config.get('DATA_CSV_SOURCES'):
+            return MultiCSVStorage.from_config(config)
+        return cls(
+            config['DATA_CSV'],
+            short_interval=config.get(
+                'ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL
+            ),
+        )
+
+    def user_ids(self):
+        """
+        Returns ids of all users with presence data.
+        """
+        return self.data.keys()
+
+    def get_user(self, user_id, date_from=None, date_to=None):
+        """
+        Returns presence entries of given user, optionally limited to
+        date range.
+        """
+        items = self.data.get(user_id, {})
+        return filter_range(items, date_from, date_to)
+
+    def get_users(self, user_ids):
+        """
+        Returns presence entries of given users grouped by user_id.
+        """
+        return {user_id: self.get_user(user_id) for user_id in user_ids}
+
+    def iter_users(self, user_ids):
+        """
+        Yields (user_id, entries) pairs of given users ordered by id.
+        """
+        for user_id in sorted(user_ids):
+            yield user_id, self.get_user(user_id)
+
+    def get_all(self):
+        """
+        Returns presence entries of all users.
+        """
+        return self.data
+
+
+class MultiCSVStorage(object):
+    """
+    Keeps presence data merged from several CSV files in memory.
+
+    Sources are given as paths or glob patterns ordered by priority and
+    parsed in parallel by `workers` processes, each by its own CSVStorage
+    sent back packed, then combined with k-way merge. On refresh only
+    changed sources are read again (just appended rows where possible)
+    and only days they contain are merged.
+    """
+    in_memory = True
+
+    def __init__(self, patterns, conflict='last', workers=4,
+                 short_interval=SHORT_INTERVAL):
+        if conflict not in CONFLICT_POLICIES:
+            raise ValueError('Unknown conflict policy: %s' % conflict)
+        self.patterns = patterns
+        self.conflict = conflict
+        self.workers = workers
+        self.short_interval = short_interval
+        self.sources = OrderedDict()
+        self.stats = {}
+        self.data = {}
+        self.anomalies = None
+        self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage using application config.
+        """
+        return cls(
+            config.get('DATA_CSV_SOURCES') or [config['DATA_CSV']],
+            conflict=config.get('DATA_CONFLICT_POLICY', 'last'),
+            workers=config.get('DATA_PARSE_WORKERS', 4),
+            short_interval=config.get(
+                'ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL
+            ),
+        )
+
+    @staticmethod
+    def _stat(path):
+        """
+        Returns modification time and size of given file.
+        """
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def parse(self, paths):
+        """
+        Parses given sources in parallel, returns CSVStorage of every path.
+
+        Parsing is CPU bound, so it runs in worker processes, not threads
+        serialized by the GIL.
+        """
+        if not paths:
+            return {}
+        workers = min(self.workers, len(paths))
+        if workers < 2:
+            storages = [
+                CSVStorage(path, self.short_interval) for path in paths
+            ]
+        else:
+            pool = Pool(workers)
+            try:
+                storages = [
+                    CSVStorage.unpack(state) for state in pool.imap(
+                        _parse_packed,
+                        [(path, self.short_interval) for path in paths]
+                    )
+                ]
+            finally:
+                pool.close()
+                pool.join()
+        for path in paths:
+            self.stats[path] = self._stat(path)
+        return dict(zip(paths, storages))
+
+    def load(self):
+        """
+        Parses all sources and merges them from scratch.
+        """
+        paths = resolve_sources(self.patterns)
+        storages = self.parse(paths)
+        self.sources = OrderedDict((path, storages[path]) for path in paths)
+        self.data = {}
+        for user_id, date, times in merge_sources(
+                [source.data for source in self.sources.itervalues()],
+                self.conflict):
+            self.data.setdefault(user_id, {})[date] = times
+        self.merge_anomalies()
+
+    def merge_anomalies(self):
+        """
+        Combines anomalies detected in all sources.
+        """
+        self.anomalies = AnomalyDetector.merge(
+            [(path, source.anomalies)
+             for path, source in self.sources.iteritems()],
+            self.short_interval
+        )
+
+    def resolve(self, user_id, date):
+        """
+        Returns presence entry of given day merged from all sources,
+        None if no source has it.
+        """
+        resolve = CONFLICT_POLICIES[self.conflict]
+        kept = None
+        for source in self.sources.itervalues():
+            times = source.data.get(user_id, {}).get(date)
+            if times is None:
+                continue
+            kept = times if kept is None else resolve(kept, times)
+        return kept
+
+    def refresh(self):
+        """
+        Reads sources changed since they were loaded and merges days they
+        contain again.
+
+        Returns list of changed (user_id, date, start, end, previous)
+        tuples; start and end are None for days no longer present in any
+        source.
+        """
+        paths = resolve_sources(self.patterns)
+        affected = set()
+        reparsed = []
+        for path, source in self.sources.iteritems():
+            if path not in paths:
+                log.info('Presence data source %s removed', path)
+                affected.update(_source_days(source))
+                continue
+            if self._stat(path) == self.stats[path]:
+                continue
+            appended = source.refresh()
+            if appended is None:
+                affected.update(_source_days(source))
+                reparsed.append(path)
+            else:
+                self.stats[path] = self._stat(path)
+                affected.update((row[0], row[1]) for row in appended)
+        reparsed.extend(path for path in paths if path not in self.sources)
+        storages = self.parse(reparsed)
+        for source in storages.itervalues():
+            affected.update(_source_days(source))
+        self.sources = OrderedDict(
+            (path, storages.get(path) or self.sources[path]) for path in paths
+        )
+        for path in self.stats.keys():
+            if path not in self.sources:
+                del self.stats[path]
+
+        # entries of affected users are copied, not changed in place
+        changes = []
+        updated = {}
+        for user_id, date in sorted(affected):
+            items = updated.get(user_id)
+            if items is None:
+                items = updated[user_id] = dict(self.data.get(user_id, {}))
+            previous = items.get(date)
+            times = self.resolve(user_id, date)
+            if times == previous:
+                pass
+            elif times is None:
+                del items[date]
+                changes.append((user_id, date, None, None, previous))
+            else:
+                items[date] = times
+                changes.append(
+                    (user_id, date, times['start'], times['end'], previous)
+                )
+        data = dict(self.data)
+        for user_id, items in updated.iteritems():
+            if items:
+                data[user_id] = items
+            else:
+                data.pop(user_id, None)
+        self.data = data
+        self.merge_anomalies()
+        return changes
+
+    def user_ids(self):
+        """
+        Returns ids of all users with presence data.
+        """
+        return self.data.keys()
+
+    def get_user(self, user_id, date_from=None, date_to=None):
+        """
+        Returns presence entries of given user, optionally limited to
+        date range.
+        """
+        items = self.data.get(user_id, {})
+        return filter_range(items, date_from, date_to)
+
+    def get_users(self, user_ids):
+        """
+        Returns presence entries of given users grouped by user_id.
+        """
+        return {user_id: self.get_user(user_id) for user_id in user_ids}
+
+    def iter_users(self, user_ids):
+        """
+        Yields (user_id, entries) pairs of given users ordered by id.
+        """
+        for user_id in sorted(user_ids):
+            yield user_id, self.get_user(user_id)
+
+    def get_all(self):
+        """
+        Returns presence entries of all users.
+        """
+        return self.data
+
+
+def _parse_packed(args):
+    """
+    Parses CSV file in worker process, returns packed CSVStorage state.
+    """
+    path, short_interval = args
+    return CSVStorage(path, short_interval).pack()
+
+
+def _source_days(source):
+    """
+    Returns (user_id, date) pairs of all days kept by CSVStorage.
+    """
+    return [
+        (user_id, date)
+        for user_id, items in source.data.iteritems() for date in items
+    ]
+
+
+class SQLiteStorage(object):
+    """
+    Presence data imported once from CSV file into indexed SQLite database.
+
+    Only rows needed to answer given query are read from the database,
+    so memory usage does not depend on the size of whole history. The
+    same holds for anomalies: only their counts are kept in memory.
+    """
+    in_memory = False
+
+    def __init__(self, csv_path, db_path, short_interval=SHORT_INTERVAL):
+        self.csv_path = csv_path
+        self.db_path = db_path
+        self.short_interval = short_interval
+        if self.is_up_to_date():
+            self.anomalies = self.read_anomalies()
+        else:
+            self.import_csv()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage using application config.
+        """
+        return cls(
+            config['DATA_CSV'],
+            config['SQLITE_DB'],
+            short_interval=config.get(
+                'ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL
+            ),
+        )
+
+    def connect(self):
+        """
+        Opens new database connection. Connections are not shared
+        between threads.
+        """
+        return sqlite3.connect(self.db_path)
+
+    def is_up_to_date(self):
+        """
+        Checks if database was imported from current version of CSV file
+        with the same anomaly detection settings.
+        """
+        if not os.path.exists(self.db_path):
+            return False
+        try:
+            conn = self.connect()
+            try:
+                meta = dict(conn.execute('SELECT key, value FROM meta'))
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError:
+            return False
+        if meta.get('source') != source_signature(self.csv_path):
+            return False
+        anomalies = json.loads(meta.get('anomalies', '{}'))
+        return (
+            'summary' in anomalies and
+            anomalies['short_interval'] == self.short_interval
+        )
+
+    def read_anomalies(self):
+        """
+        Reads summary of anomalies detected during the import.
+        """
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                'SELECT value FROM meta WHERE key = ?', ('anomalies',)
+            ).fetchone()
+        finally:
+            conn.close()
+        return StoredAnomalies(json.loads(row[0]), self.read_user_anomalies)
+
+    def read_user_anomalies(self, user_id):
+        """
+        Reads anomaly list of given user.
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                'SELECT type, date, line FROM anomalies '
+                'WHERE user_id = ? ORDER BY rowid', (user_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {'type': kind, 'date': date, 'line': line}
+            for kind, date, line in rows
+        ]
+
+    def import_csv(self):
+        """
+        Imports CSV file into a fresh database, then atomically replaces
+        the old one.
+        """
+        log.info('Importing %s into %s', self.csv_path, self.db_path)
+        tmp_path = '%s.%d.tmp' % (self.db_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        detector = AnomalyDetector(self.short_interval)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.executescript(
+                """
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE presence (
+                    user_id INTEGER NOT NULL,
+                    date TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, date)
+                );
+                CREATE TABLE anomalies (
+                    user_id INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    date TEXT,
+                    line INTEGER
+                );
+                CREATE INDEX anomalies_user ON anomalies (user_id);
+                """
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                (
+                    (
+                        user_id, date.isoformat(),
+                        to_seconds(start), to_seconds(end),
+                    )
+                    for user_id, date, start, end
+                    in parse_csv(self.csv_path, detector)
+                )
+            )
+            detector.finish()
+            conn.executemany(
+                'INSERT INTO anomalies VALUES (?, ?, ?, ?)',
+                (
+                    (user_id, anomaly['type'], anomaly['date'],
+                     anomaly['line'])
+                    for user_id, anomalies
+                    in sorted(detector.anomalies.iteritems())
+                    for anomaly in anomalies
+                )
+            )
+            summary = StoredAnomalies.dump(detector)
+            conn.executemany(
+                'INSERT INTO meta VALUES (?, ?)', [
+                    ('source', source_signature(self.csv_path)),
+                    ('anomalies', json.dumps(summary)),
+                ]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp_path, self.db_path)
+        self.anomalies = StoredAnomalies(summary, self.read_user_anomalies)
+
+    @staticmethod
+    def _row_to_item(row):
+        """
+        Converts database row to (date, {'start': ..., 'end': ...}) pair.
+        """
+        date = datetime.strptime(row[0], '%Y-%m-%d').date()
+        return date, {
+            'start': from_seconds(row[1]),
+            'end': from_seconds(row[2]),
+        }
+
+    def user_ids(self):
+        """
+        Returns ids of all users with presence data.
+        """
+        conn = self.connect()
+        try:
+            return [
+                row[0] for row in
+                conn.execute('SELECT DISTINCT user_id FROM presence')
+            ]
+        finally:
+            conn.close()
+
+    def get_user(self, user_id, date_from=None, date_to=None):
+        """
+        Returns presence entries of given user, optionally limited to
+        date range.
+        """
+        query = 'SELECT date, start, end FROM presence WHERE user_id = ?'
+        params = [user_id]
+        if date_from is not None:
+            query += ' AND date >= ?'
+            params.append(date_from.isoformat())
+        if date_to is not None:
+            query += ' AND date <= ?'
+            params.append(date_to.isoformat())
+        conn = self.connect()
+        try:
+            return dict(
+                self._row_to_item(row) for row in conn.execute(query, params)
+            )
+        finally:
+            conn.close()
+
+    def get_users(self, user_ids):
+        """
+        Returns presence entries of given users grouped by user_id,
+        read by single query per SQLITE_BATCH users.
+        """
+        user_ids = list(user_ids)
+        data = {user_id: {} for user_id in user_ids}
+        conn = self.connect()
+        try:
+            for i in range(0, len(user_ids), SQLITE_BATCH):
+                batch = user_ids[i:i + SQLITE_BATCH]
+                query = (
+                    'SELECT user_id, date, start, end FROM presence '
+                    'WHERE user_id IN (%s)' % ', '.join('?' * len(batch))
+                )
+                for row in conn.execute(query, batch):
+                    date, times = self._row_to_item(row[1:])
+                    data[row[0]][date] = times
+        finally:
+            conn.close()
+        return data
+
+    def iter_users(self, user_ids):
+        """
+        Yields (user_id, entries) pairs of given users ordered by id,
+        read by single query per SQLITE_BATCH users.
+        """
+        user_ids = sorted(user_ids)
+        for i in range(0, len(user_ids), SQLITE_BATCH):
+            batch = user_ids[i:i + SQLITE_BATCH]
+            data = self.get_users(batch)
+            for user_id in batch:
+                yield user_id, data[user_id]
+
+    def get_all(self):
+        """
+        Returns presence entries of all users. Loads the whole dataset,
+        use per-user queries where possible.
+        """
+        data = {}
+        conn = self.connect()
+        try:
+            for row in conn.execute(
+                    'SELECT user_id, date, start, end FROM presence'):
+                date, times = self._row_to_item(row[1:])
+                data.setdefault(row[0], {})[date] = times
+        finally:
+            conn.close()
+        return data
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping keeping only recently used items.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns cached item and marks it as recently used.
+        """
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Stores item, dropping least recently used ones over the limit.
+        """
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ShardedStorage(object):
+    """
+    Presence data partitioned into per-user-range shard files.
+
+    Every shard holds rows of `shard_size` consecutive user ids packed
+    as native int32 quadruples (user_id, date ordinal, start, end), where
+    start and end are seconds since midnight. The index file maps user
+    ids to shard names. Shards are read only when one of their users is
+    requested and kept in a bounded LRU cache.
+
+    Anomaly lists of a shard's users are kept in a JSON file next to the
+    shard and read when one of the users is requested, the index holds
+    only their counts.
+
+    Every import writes shards into a new generation directory and then
+    replaces the index, so storages opened before keep reading their own
+    generation. Only the current and the previous generation are kept.
+    """
+    INDEX = 'index.json'
+    FLUSH_ROWS = 10000
+    in_memory = False
+
+    def __init__(self, shards_dir, csv_path=None, shard_size=1,
+                 cache_size=100, short_interval=SHORT_INTERVAL):
+        self.shards_dir = shards_dir
+        self.csv_path = csv_path
+        self.shard_size = shard_size
+        self.short_interval = short_interval
+        self.cache = LRUCache(cache_size)
+        self.index = self.read_index()
+        if csv_path is not None and not self.is_up_to_date():
+            self.import_csv()
+        elif self.index is None:
+            log.error('No shards index found in %s', shards_dir)
+            self.index = {
+                'source': None,
+                'shard_size': shard_size,
+                'users': {},
+                'anomalies': StoredAnomalies.dump(
+                    AnomalyDetector(short_interval)
+                ),
+            }
+        self.anomalies = StoredAnomalies(
+            self.index['anomalies'], self.read_user_anomalies
+        )
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage using application config.
+        """
+        return cls(
+            config['SHARDS_DIR'],
+            csv_path=config.get('DATA_CSV'),
+            shard_size=config.get('SHARD_SIZE', 1),
+            cache_size=config.get('SHARD_CACHE_SIZE', 100),
+            short_interval=config.get(
+                'ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL
+            ),
+        )
+
+    def read_index(self):
+        """
+        Reads shards index, returns None if it does not exist.
+        """
+        try:
+            with open(os.path.join(self.shards_dir, self.INDEX)) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return None
+
+    def is_up_to_date(self):
+        """
+        Checks if shards were built from current version of CSV file
+        with the same settings.
+        """
+        return (
+            self.index is not None and
+            'summary' in self.index.get('anomalies', {}) and
+            self.index['source'] == source_signature(self.csv_path) and
+            self.index['shard_size'] == self.shard_size and
+            self.index['anomalies']['short_interval'] == self.short_interval
+        )
+
+    def shard_name(self, user_id):
+        """
+        Returns name of shard file holding given user.
+        """
+        return 'shard_%d.bin' % (user_id // self.shard_size)
+
+    @staticmethod
+    def anomalies_name(name):
+        """
+        Returns name of file holding anomalies of given shard's users.
+        """
+        return '%s.anomalies.json' % os.path.splitext(name)[0]
+
+    def shard_path(self, name):
+        """
+        Returns path of shard file in generation of current index.
+        """
+        return os.path.join(
+            self.shards_dir, self.index.get('generation', ''), name
+        )
+
+    def generations(self):
+        """
+        Returns numbers of generation directories, oldest first.
+        """
+        numbers = []
+        for name in os.listdir(self.shards_dir):
+            if name.startswith('generation_'):
+                try:
+                    numbers.append(int(name[len('generation_'):]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    def import_csv(self):
+        """
+        Partitions CSV file into shard files of new generation and
+        writes their index.
+
+        Rows are buffered and appended to shard files in batches of
+        FLUSH_ROWS rows, so memory usage does not grow with size of CSV
+        file.
+        """
+        log.info('Importing %s into %s', self.csv_path, self.shards_dir)
+        if not os.path.isdir(self.shards_dir):
+            os.makedirs(self.shards_dir)
+        generations = self.generations()
+        generation = 'generation_%d' % (
+            generations[-1] + 1 if generations else 1
+        )
+        os.mkdir(os.path.join(self.shards_dir, generation))
+
+        users = {}
+        buffers = {}
+        buffered = [0]
+        detector = AnomalyDetector(self.short_interval)
+
+        def flush():
+            """
+            Appends buffered rows to shard files.
+            """
+            for name, rows in buffers.iteritems():
+                path = os.path.join(self.shards_dir, generation, name)
+                with open(path, 'ab') as shard:
+                    rows.tofile(shard)
+            buffers.clear()
+            buffered[0] = 0
+
+        for user_id, date, start, end in parse_csv(self.csv_path, detector):
+            name = users.setdefault(user_id, self.shard_name(user_id))
+            buffers.setdefault(name, array('i')).extend(
+                (user_id, date.toordinal(), to_seconds(start), to_seconds(end))
+            )
+            buffered[0] += 1
+            if buffered[0] >= self.FLUSH_ROWS:
+                flush()
+        flush()
+
+        detector.finish()
+        shard_anomalies = {}
+        for user_id, anomalies in detector.anomalies.iteritems():
+            shard_anomalies.setdefault(self.shard_name(user_id), {})[
+                str(user_id)
+            ] = anomalies
+        for name, anomalies in shard_anomalies.iteritems():
+            path = os.path.join(
+                self.shards_dir, generation, self.anomalies_name(name)
+            )
+            with open(path, 'w') as anomalies_file:
+                json.dump(anomalies, anomalies_file)
+
+        self.index = {
+            'source': source_signature(self.csv_path),
+            'shard_size': self.shard_size,
+            'generation': generation,
+            'users': {str(user_id): name for user_id, name in users.items()},
+            'anomalies': StoredAnomalies.dump(detector),
+        }
+        tmp_path = os.path.join(self.shards_dir, '%s.tmp' % self.INDEX)
+        with open(tmp_path, 'w') as index:
+            json.dump(self.index, index)
+        os.rename(tmp_path, os.path.join(self.shards_dir, self.INDEX))
+        self.cache = LRUCache(self.cache.max_size)
+        self.anomalies = StoredAnomalies(
+            self.index['anomalies'], self.read_user_anomalies
+        )
+        # previous generation may still be read by in-flight requests
+        for number in generations[:-1]:
+            shutil.rmtree(os.path.join(
+                self.shards_dir, 'generation_%d' % number
+            ), ignore_errors=True)
+
+    def read_shard(self, name):
+        """
+        Decodes shard file into a dict of users' presence entries.
+        """
+        path = self.shard_path(name)
+        rows = array('i')
+        with open(path, 'rb') as shard:
+            rows.fromstring(shard.read())
+        return decode_rows(rows)
+
+    def read_user_anomalies(self, user_id):
+        """
+        Reads anomaly list of given user from file of user's shard.
+        """
+        path = self.shard_path(self.anomalies_name(self.shard_name(user_id)))
+        try:
+            with open(path) as anomalies_file:
+                return json.load(anomalies_file).get(str(user_id), [])
+        except IOError:
+            return []
+
+    def load_shard(self, name):
+        """
+        Returns decoded shard, reading it from disk if it is not cached.
+        """
+        data = self.cache.get(name)
+        if data is None:
+            data = self.read_shard(name)
+            self.cache.set(name, data)
+        return data
+
+    def user_ids(self):
+        """
+        Returns ids of all users with presence data.
+        """
+        return [int(user_id) for user_id in self.index['users']]
+
+    def get_user(self, user_id, date_from=None, date_to=None):
+        """
+        Returns presence entries of given user, optionally limited to
+        date range.
+        """
+        name = self.index['users'].get(str(user_id))
+        if name is None:
+            return {}
+        items = self.load_shard(name).get(user_id, {})
+        return filter_range(items, date_from, date_to)
+
+    def get_users(self, user_ids):
+        """
+        Returns presence entries of given users grouped by user_id.
+        """
+        return {user_id: self.get_user(user_id) for user_id in user_ids}
+
+    def iter_users(self, user_ids):
+        """
+        Yields (user_id, entries) pairs of given users ordered by id.
+        Shards are read without caching them, so a full scan does not
+        evict users requested often.
+        """
+        name, data = None, {}
+        for user_id in sorted(user_ids):
+            shard = self.index['users'].get(str(user_id))
+            if shard is not None and shard != name:
+                name, data = shard, self.read_shard(shard)
+            yield user_id, data.get(user_id, {}) if shard else {}
+
+    def get_all(self):
+        """
+        Returns presence entries of all users. Reads every shard without
+        caching them, use per-user queries where possible.
+        """
+        data = {}
+        for name in set(self.index['users'].itervalues()):
+            data.update(self.read_shard(name))
+        return data
+
+
+class MmapAnomalies(AnomalyDetector):
+    """
+    Anomalies of memory-mapped storage, detected as users are decoded.
+    First summary decodes all users without caching them, so company
+    counts are complete.
+    """
+
+    def __init__(self, storage, short_interval=SHORT_INTERVAL):
+        super(MmapAnomalies, self).__init__(short_interval)
+        self.storage = storage
+        self.scanned = False
+        self.lock = Lock()
+
+    def summary(self):
+        """
+        Returns company-wide anomaly counts.
+        """
+        with self.lock:
+            if not self.scanned:
+                for user_id in self.storage.user_ids():
+                    self.storage.decode(user_id)
+                self.scanned = True
+        return super(MmapAnomalies, self).summary()
+
+
+class MmapCSVStorage(object):
+    """
+    Presence CSV file mapped into memory and indexed by user.
+
+    Single pass over the file builds only user_id -> line offsets index.
+    Rows of a user are decoded when they are requested for the first time
+    and kept in a bounded LRU cache. Anomalies of a user are detected
+    while decoding the user's rows, without line numbers; company summary
+    of anomalies decodes the whole file once.
+
+    New versions of the file have to replace it by rename: reading a part
+    of the mapping cut off by truncating the file in place kills the
+    process with SIGBUS. Size of the file is checked before decoding, which
+    narrows that window, but does not close it.
+    """
+    in_memory = False
+
+    def __init__(self, path, cache_size=1000,
+                 short_interval=SHORT_INTERVAL):
+        self.path = path
+        self.cache = LRUCache(cache_size)
+        self.anomalies = MmapAnomalies(self, short_interval)
+        self.offsets = {}
+        with open(path, 'rb') as csvfile:
+            self.map = mmap.mmap(
+                csvfile.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        self.build_index()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage using application config. Files smaller than
+        MMAP_MIN_SIZE are loaded whole into memory instead.
+        """
+        short_interval = config.get('ANOMALY_SHORT_INTERVAL', SHORT_INTERVAL)
+        min_size = config.get('MMAP_MIN_SIZE', 64 * 1024 * 1024)
+        if os.path.getsize(config['DATA_CSV']) < max(min_size, 1):
+            return CSVStorage(config['DATA_CSV'], short_interval)
+        return cls(
+            config['DATA_CSV'],
+            cache_size=config.get('MMAP_CACHE_SIZE', 1000),
+            short_interval=short_interval,
+        )
+
+    def build_index(self):
+        """
+        Finds offsets of every user's lines.
+        """
+        size = len(self.map)
+        position = 0
+        line = 0
+        while position < size:
+            line += 1
+            end = self.map.find('\n', position)
+            if end == -1:
+                end = size
+            separator = self.map.find(',', position, end)
+            if separator == -1:
+                # header or footer line
+                position = end + 1
+                continue
+            try:
+                user_id = int(self.map[position:separator])
+            except ValueError:
+                # header, footer or malformed line
+                if self.map[position:end].count(',') == 3:
+                    self.anomalies.malformed_lines.append(line)
+            else:
+                self.offsets.setdefault(user_id, array('L')).append(position)
+            position = end + 1
+
+    def iter_lines(self, user_id):
+        """
+        Yields lines of given user.
+        """
+        for position in self.offsets.get(user_id, ()):
+            end = self.map.find('\n', position)
+            yield self.map[position:end if end != -1 else len(self.map)]
+
+    def decode(self, user_id):
+        """
+        Parses rows of given user and records their anomalies.
+        """
+        if self.map.size() < len(self.map):
+            raise IOError(
+                'Presence data file %s truncated while mapped' % self.path
+            )
+        detector = AnomalyDetector(self.anomalies.short_interval)
+        items = {}
+        for _, date, start, end in parse_lines(
+                self.iter_lines(user_id), detector):
+            items[date] = {'start': start, 'end': end}
+        detector.finish()
+        anomalies = detector.anomalies.get(user_id)
+        if anomalies:
+            for anomaly in anomalies:
+                anomaly['line'] = None
+            self.anomalies.anomalies[user_id] = anomalies
+        else:
+            self.anomalies.anomalies.pop(user_id, None)
+        return items
+
+    def user_ids(self):
+        """
+        Returns ids of all users with presence data.
+        """
+        return self.offsets.keys()
+
+    def get_user(self, user_id, date_from=None, date_to=None):
+        """
+        Returns presence entries of given user, optionally limited to
+        date range.
+        """
+        if user_id not in self.offsets:
+            return {}
+        items = self.cache.get(user_id)
+        if items is None:
+            items = self.decode(user_id)
+            self.cache.set(user_id, items)
+        return filter_range(items, date_from, date_to)
+
+    def get_users(self, user_ids):
+        """
+        Returns presence entries of given users grouped by user_id.
+        """
+        return {user_id: self.get_user(user_id) for user_id in user_ids}
+
+    def iter_users(self, user_ids):
+        """
+        Yields (user_id, entries) pairs of given users ordered by id.
+        Users are decoded without caching them, so a full scan does not
+        evict users requested often.
+        """
+        for user_id in sorted(user_ids):
+            if user_id in self.offsets:
+                yield user_id, self.decode(user_id)
+            else:
+                yield user_id, {}
+
+    def get_all(self):
+        """
+        Returns presence entries of all users. Decodes whole file without
+        caching it, use per-user queries where possible.
+        """
+        return {user_id: self.decode(user_id) for user_id in self.offsets}
+
+
+BACKENDS = {
+    'csv': CSVStorage,
+    'sqlite': SQLiteStorage,
+    'sharded': ShardedStorage,
+    'mmap': MmapCSVStorage,
+}
+
+
+def create_storage(config):
+    """
+    Creates storage backend selected by STORAGE_BACKEND config option.
+    Several CSV sources (DATA_CSV_SOURCES) are read only by csv backend.
+    """
+    name = config.get('STORAGE_BACKEND', 'csv')
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown storage backend: %s' % name)
+    if config.get('DATA_CSV_SOURCES') and name != 'csv':
+        raise ValueError(
+            'DATA_CSV_SOURCES is not supported by %s storage backend' % name
+        )
+    return backend.from_config(config)
@@ -6,17 +6,33 @@ from __future__ import unicode_literals
 
 import os.path
 import json
+import subprocess
+import sys
+import shutil
 import datetime
+import gzip
+import random
+import tempfile
+from StringIO import StringIO
+import time
+import threading
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
 
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    main, views, utils, storage, anomalies, watcher, export, rollups,
+    helpers, warmup, coalesce, generate_data, importtime, users, script
+)
 
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
+TEST_ANOMALIES_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'test_anomalies_data.csv'
+)
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
@@ -35,7 +51,7 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'DATA_XML': TEST_DATA_XML})
         self.weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-        self.client = main.app.test_client()
+        self.client = main.load_views().test_client()
         self.valid_user_id = '10'
         self.invalid_user_id = '20'
 
@@ -63,6 +79,35 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         self.assertEqual(resp.data, 'Requested template does not exist.')
 
+    def test_render_page_user_preloaded_data(self):
+        """
+        Test users listing and user's data embedded in rendered page.
+        """
+        resp = self.client.get('render/presence_weekday')
+        self.assertIn(
+            'var preloaded = {"users": [{"user_id": 141, ', resp.data
+        )
+        self.assertIn('"user_id": null, "data": null}', resp.data)
+
+        resp = self.client.get(
+            'render/presence_weekday?user_id=' + self.valid_user_id
+        )
+        self.assertIn(
+            '"user_id": 10, "data": [["Weekday", "Presence (s)"], ["Mon", 0]',
+            resp.data
+        )
+        resp = self.client.get(
+            'render/monthly_hours?user_id=' + self.invalid_user_id
+        )
+        self.assertIn('"user_id": 20, "data": 404}', resp.data)
+
+        main.app.config.update({'PRELOAD_DATA': False})
+        try:
+            resp = self.client.get('render/presence_weekday?user_id=10')
+        finally:
+            main.app.config.update({'PRELOAD_DATA': True})
+        self.assertIn('var preloaded = null || {};', resp.data)
+
     def test_api_users(self):
         """
         Test users listing.
@@ -80,6 +125,23 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
 
+        resp = self.client.get('/api/v1/users?order=surname')
+        self.assertEqual(
+            [user['name'] for user in json.loads(resp.data)[:3]],
+            ['Anna D.', 'Damian G.', 'Agata J.']
+        )
+        resp = self.client.get('/api/v1/users?order=id&q=an')
+        self.assertEqual(
+            [user['user_id'] for user in json.loads(resp.data)],
+            [19, 26, 36, 165]
+        )
+        resp = self.client.get('/api/v1/users?q=anna+k')
+        self.assertEqual(
+            [user['user_id'] for user in json.loads(resp.data)], [19]
+        )
+        resp = self.client.get('/api/v1/users?order=unknown')
+        self.assertEqual(resp.status_code, 400)
+
         main.app.config.update({'DATA_XML': 'non_existing_file.xml'})
         resp = self.client.get('/api/v1/users')
         self.assertEqual(resp.data, '[]')
@@ -105,6 +167,200 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         ]
         self.assertEqual(data, expected_data)
 
+    def test_percentile_time_weekday_api(self):
+        """
+        Test median and percentile time weekday api responses.
+        """
+        resp = self.client.get(
+            '/api/v1/median_time_weekday/' + self.valid_user_id
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        expected_data = [
+            ['Mon', 0], ['Tue', 30047.0], ['Wed', 24465.0],
+            ['Thu', 23705.0], ['Fri', 0], ['Sat', 0], ['Sun', 0]
+        ]
+        self.assertEqual(json.loads(resp.data), expected_data)
+
+        resp = self.client.get(
+            '/api/v1/percentile_time_weekday/%s/90' % self.valid_user_id
+        )
+        self.assertEqual(json.loads(resp.data), expected_data)
+        resp = self.client.get(
+            '/api/v1/percentile_time_weekday/%s/101' % self.valid_user_id
+        )
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get(
+            '/api/v1/median_time_weekday/' + self.invalid_user_id
+        )
+        self.assertEqual(resp.data, '404')
+
+    def test_percentile_from_to_api(self):
+        """
+        Test median and percentile start-end api responses.
+        """
+        resp = self.client.get(
+            '/api/v1/median_from_to/' + self.valid_user_id
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        expected_data = [
+            ['Mon', 0, 0], ['Tue', 34745, 64792], ['Wed', 33592, 58057],
+            ['Thu', 38926, 62631], ['Fri', 0, 0], ['Sat', 0, 0], ['Sun', 0, 0]
+        ]
+        self.assertEqual(json.loads(resp.data), expected_data)
+        resp = self.client.get(
+            '/api/v1/percentile_from_to/%s/10' % self.valid_user_id
+        )
+        self.assertEqual(json.loads(resp.data), expected_data)
+        resp = self.client.get(
+            '/api/v1/median_from_to/' + self.invalid_user_id
+        )
+        self.assertEqual(resp.data, '404')
+
+    def test_presence_histogram_api(self):
+        """
+        Test arrival and departure histogram api responses.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_histogram/%s?bucket=60' % self.valid_user_id
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 25)
+        self.assertEqual(data[0], ['Time', 'Arrivals', 'Departures'])
+        self.assertEqual(data[10], ['09:00', 2, 0])
+        self.assertEqual(data[11], ['10:00', 1, 0])
+        self.assertEqual(data[17], ['16:00', 0, 1])
+        self.assertEqual(data[18], ['17:00', 0, 2])
+
+        resp = self.client.get(
+            '/api/v1/presence_histogram/' + self.valid_user_id
+        )
+        self.assertEqual(len(json.loads(resp.data)), 49)
+        resp = self.client.get(
+            '/api/v1/presence_histogram/' + self.invalid_user_id
+        )
+        self.assertEqual(resp.data, '404')
+        for bucket in ('0', '1441', 'x'):
+            resp = self.client.get(
+                '/api/v1/presence_histogram/%s?bucket=%s' % (
+                    self.valid_user_id, bucket
+                )
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_export_api(self):
+        """
+        Test packed and CSV export api responses.
+        """
+        main.app.config.update({'EXPORT_CHUNK_ROWS': 2})
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/octet-stream')
+        rows = export.unpack(resp.data)
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(
+            rows[0],
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        )
+        self.assertEqual([row[0] for row in rows], [10] * 3 + [11] * 6)
+
+        resp = self.client.get(
+            '/api/v1/export?format=csv&user_id=10,20&from=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(
+            resp.data,
+            '10,2013-09-11,09:19:52,16:07:37\n'
+            '10,2013-09-12,10:48:46,17:23:51\n'
+        )
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_rollup_api(self):
+        """
+        Test weekly, monthly and yearly rollups api responses.
+        """
+        resp = self.client.get('/api/v1/rollup/month/' + self.valid_user_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), [
+            ['Period', 'Presence (s)', 'Days', 'Start', 'End'],
+            ['2013-09', 78217, 3, 35754, 61826],
+        ])
+        resp = self.client.get('/api/v1/rollup/week/' + self.valid_user_id)
+        self.assertEqual(
+            json.loads(resp.data)[1:],
+            [['2013-W37', 78217, 3, 35754, 61826]]
+        )
+        resp = self.client.get('/api/v1/rollup/year')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[1][:3], ['2013', 196619, 9])
+        resp = self.client.get('/api/v1/rollup/day/' + self.valid_user_id)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/rollup/year/' + self.invalid_user_id)
+        self.assertEqual(resp.data, '404')
+
+    def test_rollup_api_sqlite(self):
+        """
+        Test storage not kept in memory has no rollups of every user.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        main.app.config.update({
+            'STORAGE_BACKEND': 'sqlite',
+            'SQLITE_DB': os.path.join(tmp_dir, 'presence.db'),
+        })
+        main.app.extensions.pop('presence_data', None)
+        utils.cache.clear()
+        try:
+            resp = self.client.get(
+                '/api/v1/rollup/month/' + self.valid_user_id
+            )
+            self.assertEqual(json.loads(resp.data)[1:], [
+                ['2013-09', 78217, 3, 35754, 61826],
+            ])
+            resp = self.client.get('/api/v1/monthly_hours/10')
+            self.assertEqual(json.loads(resp.data)[9], ['Sep', 21])
+            self.assertIsNone(main.app.extensions['presence_data']['rollups'])
+            resp = self.client.get('/api/v1/rollup/year')
+            self.assertEqual(json.loads(resp.data)[1][:3], ['2013', 196619, 9])
+            self.assertEqual(utils.get_rollups().users, {})
+        finally:
+            main.app.config.update({'STORAGE_BACKEND': 'csv'})
+            del main.app.config['SQLITE_DB']
+            main.app.extensions.pop('presence_data', None)
+            utils.cache.clear()
+            shutil.rmtree(tmp_dir)
+
+    def test_rollups_incremental_update(self):
+        """
+        Test rollups are updated with rows appended to CSV file.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(TEST_DATA_CSV) as source, open(path, 'w') as target:
+            target.write(source.read() + '\n')
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            resp = self.client.get('/api/v1/monthly_hours/10')
+            self.assertEqual(json.loads(resp.data)[9], ['Sep', 21])
+            loaded = utils.get_storage()
+            with open(path, 'a') as csvfile:
+                csvfile.write('10,2013-09-13,08:00:00,18:00:00\n')
+            resp = self.client.get('/api/v1/monthly_hours/10')
+            self.assertEqual(json.loads(resp.data)[9], ['Sep', 31])
+            self.assertIs(utils.get_storage(), loaded)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmp_dir)
+
     def test_presence_weekday_api(self):
         """
         Test presence weekday api responses.
@@ -212,6 +468,22 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_run_reload(self):
+        """
+        Test handing data reloads off to registered executor.
+        """
+        function = Mock(return_value='data')
+        self.assertEqual(utils.run_reload(function, 1), 'data')
+        function.assert_called_once_with(1)
+
+        executor = Mock(return_value='executed')
+        main.app.extensions['reload_executor'] = executor
+        try:
+            self.assertEqual(utils.run_reload(function, 2), 'executed')
+        finally:
+            del main.app.extensions['reload_executor']
+        executor.assert_called_once_with(function, 2)
+
     def test_group_by_weekday(self):
         """
         Test group by weekday utility.
@@ -264,6 +536,87 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             utils.usual_presence_time(data[10]), desired_data
         )
 
+    def test_percentile(self):
+        """
+        Test percentile and median utilities.
+        """
+        items = [7, 1, 5, 3, 9, 3]
+        self.assertEqual(utils.median(items), 4.0)
+        self.assertEqual(utils.percentile(items, 0), 1)
+        self.assertEqual(utils.percentile(items, 100), 9)
+        self.assertAlmostEqual(utils.percentile(items, 90), 8.0)
+        self.assertEqual(utils.median([2, 1, 3]), 2)
+        self.assertEqual(utils.median([]), 0)
+        self.assertEqual(items, [7, 1, 5, 3, 9, 3])
+
+    def test_histogram(self):
+        """
+        Test histogram utility.
+        """
+        times = [
+            datetime.time(0, 0), datetime.time(8, 59, 59),
+            datetime.time(9, 0), datetime.time(23, 59, 59)
+        ]
+        counts = utils.histogram(times, 3600)
+        self.assertEqual(len(counts), 24)
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[8], 1)
+        self.assertEqual(counts[9], 1)
+        self.assertEqual(counts[23], 1)
+        self.assertEqual(sum(counts), 4)
+        self.assertEqual(len(utils.histogram(times, 7 * 3600)), 4)
+
+    def test_rollups(self):
+        """
+        Test rollups building and replacing days.
+        """
+        csv_storage = storage.CSVStorage(TEST_DATA_CSV)
+        data_rollups = rollups.Rollups.build(csv_storage)
+        self.assertEqual(
+            data_rollups.get_user(10, 'month'),
+            {(2013, 9): [78217, 3, 107263, 185480]}
+        )
+        self.assertEqual(
+            data_rollups.get_user(10, 'year'),
+            {(2013,): [78217, 3, 107263, 185480]}
+        )
+        self.assertIsNone(data_rollups.get_user(20, 'month'))
+        self.assertEqual(
+            data_rollups.get_company('week'),
+            {(2013, 36): [22999, 1, 34088, 57087],
+             (2013, 37): [173620, 8, 292125, 465745]}
+        )
+        built = data_rollups
+        data_rollups = built.apply([(
+            10, datetime.date(2013, 9, 10),
+            datetime.time(9), datetime.time(10),
+            csv_storage.get_user(10)[datetime.date(2013, 9, 10)]
+        )])
+        self.assertEqual(
+            data_rollups.get_user(10, 'month'),
+            {(2013, 9): [78217 - 30047 + 3600, 3, 107263 - 34745 + 32400,
+                         185480 - 64792 + 36000]}
+        )
+        # applied rows do not change buckets of previous rollups
+        self.assertEqual(
+            built.get_user(10, 'month'),
+            {(2013, 9): [78217, 3, 107263, 185480]}
+        )
+        self.assertIs(
+            data_rollups.get_user(11, 'month'), built.get_user(11, 'month')
+        )
+        data_rollups.add(
+            11, datetime.date(2013, 9, 5), None, None,
+            previous=csv_storage.get_user(11)[datetime.date(2013, 9, 5)]
+        )
+        self.assertNotIn((2013, 36), data_rollups.get_company('week'))
+
+        company_rollups = rollups.Rollups.build(csv_storage, per_user=False)
+        self.assertEqual(company_rollups.users, {})
+        self.assertEqual(
+            company_rollups.get_company('week'), built.get_company('week')
+        )
+
     def test_memorize_decorator(self):
         """
         Test memorize decorator.
@@ -278,6 +631,26 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertFalse(function_mock.called)
         self.assertEqual(storage.keys()[0], 'mock.fake:::[]::[]')
 
+    def test_memorize_versioned(self):
+        """
+        Test versioned memorize decorator keeps values until dataset
+        version changes.
+        """
+        storage = {}
+        function_mock = Mock(__name__='fake', return_value=1)
+        dec_func = utils.memorize(
+            0, storage=storage, versioned=True
+        )(function_mock)
+        dec_func()
+        dec_func()
+        self.assertEqual(function_mock.call_count, 1)
+        main.app.config.update({'DATA_CSV': TEST_ANOMALIES_CSV})
+        try:
+            dec_func()
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertEqual(function_mock.call_count, 2)
+
     def test_monthly_hours(self):
         """
         Test monthly hours utility.
@@ -293,6 +666,1299 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         )
 
 
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """
+    Storage backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'presence.sqlite')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_csv_storage(self):
+        """
+        Test CSV storage backend.
+        """
+        csv_storage = storage.CSVStorage(TEST_DATA_CSV)
+        self.assertItemsEqual(csv_storage.user_ids(), [10, 11])
+        self.assertEqual(len(csv_storage.get_user(10)), 3)
+        self.assertEqual(csv_storage.get_user(20), {})
+        items = csv_storage.get_user(
+            10, date_from=datetime.date(2013, 9, 11)
+        )
+        self.assertItemsEqual(
+            items.keys(),
+            [datetime.date(2013, 9, 11), datetime.date(2013, 9, 12)]
+        )
+
+    def test_sqlite_storage(self):
+        """
+        Test SQLite storage backend gives the same results as CSV one.
+        """
+        csv_storage = storage.CSVStorage(TEST_DATA_CSV)
+        sqlite_storage = storage.SQLiteStorage(TEST_DATA_CSV, self.db_path)
+        self.assertTrue(os.path.exists(self.db_path))
+        self.assertTrue(sqlite_storage.is_up_to_date())
+        self.assertIsInstance(
+            sqlite_storage.anomalies, anomalies.StoredAnomalies
+        )
+        sqlite_storage.short_interval = 60
+        self.assertFalse(sqlite_storage.is_up_to_date())
+        sqlite_storage.short_interval = storage.SHORT_INTERVAL
+        self.assertItemsEqual(sqlite_storage.user_ids(), [10, 11])
+        self.assertEqual(sqlite_storage.get_all(), csv_storage.get_all())
+        self.assertEqual(sqlite_storage.get_user(10), csv_storage.get_user(10))
+        self.assertEqual(sqlite_storage.get_user(20), {})
+        self.assertEqual(
+            sqlite_storage.get_users([10, 11, 20]),
+            csv_storage.get_users([10, 11, 20])
+        )
+        self.assertEqual(
+            list(sqlite_storage.iter_users([11, 20, 10])),
+            list(csv_storage.iter_users([10, 11, 20]))
+        )
+        items = sqlite_storage.get_user(
+            10,
+            date_from=datetime.date(2013, 9, 11),
+            date_to=datetime.date(2013, 9, 11)
+        )
+        self.assertItemsEqual(items.keys(), [datetime.date(2013, 9, 11)])
+
+    def test_sharded_storage(self):
+        """
+        Test sharded storage backend loads only requested shards.
+        """
+        shards_dir = os.path.join(self.tmp_dir, 'shards')
+        csv_storage = storage.CSVStorage(TEST_DATA_CSV)
+        sharded_storage = storage.ShardedStorage(
+            shards_dir, csv_path=TEST_DATA_CSV, cache_size=1
+        )
+        self.assertTrue(sharded_storage.is_up_to_date())
+        sharded_storage.short_interval = 60
+        self.assertFalse(sharded_storage.is_up_to_date())
+        sharded_storage.short_interval = storage.SHORT_INTERVAL
+        self.assertItemsEqual(
+            os.listdir(shards_dir), ['index.json', 'generation_1']
+        )
+        self.assertItemsEqual(
+            os.listdir(os.path.join(shards_dir, 'generation_1')),
+            ['shard_10.bin', 'shard_11.bin', 'shard_11.anomalies.json']
+        )
+        self.assertItemsEqual(sharded_storage.user_ids(), [10, 11])
+        self.assertEqual(len(sharded_storage.cache), 0)
+        self.assertEqual(
+            sharded_storage.get_user(10), csv_storage.get_user(10)
+        )
+        self.assertEqual(
+            sharded_storage.get_user(11), csv_storage.get_user(11)
+        )
+        self.assertEqual(len(sharded_storage.cache), 1)
+        self.assertEqual(sharded_storage.get_user(20), {})
+        sharded_storage.cache = storage.LRUCache(1)
+        self.assertEqual(
+            list(sharded_storage.iter_users([20, 11, 10])),
+            list(csv_storage.iter_users([10, 11, 20]))
+        )
+        self.assertEqual(len(sharded_storage.cache), 0)
+        self.assertEqual(sharded_storage.get_all(), csv_storage.get_all())
+
+        reopened = storage.ShardedStorage(shards_dir)
+        self.assertEqual(reopened.get_user(10), csv_storage.get_user(10))
+
+        # re-import does not disturb storage reading previous generation
+        sharded_storage.import_csv()
+        sharded_storage.import_csv()
+        self.assertItemsEqual(
+            os.listdir(shards_dir),
+            ['index.json', 'generation_2', 'generation_3']
+        )
+        self.assertEqual(
+            sharded_storage.get_user(10), csv_storage.get_user(10)
+        )
+
+    def test_sharded_storage_flush(self):
+        """
+        Test rows of all shards are flushed once FLUSH_ROWS are buffered.
+        """
+        shards_dir = os.path.join(self.tmp_dir, 'shards')
+        flushed = []
+        original_tofile = storage.array.tofile
+
+        class CountingArray(storage.array):
+            """
+            Array recording sizes of flushed buffers.
+            """
+            def tofile(self, output):
+                flushed.append(len(self) // 4)
+                original_tofile(self, output)
+
+        storage.ShardedStorage.FLUSH_ROWS = 4
+        storage.array = CountingArray
+        try:
+            sharded_storage = storage.ShardedStorage(
+                shards_dir, csv_path=TEST_DATA_CSV
+            )
+        finally:
+            storage.array = CountingArray.__bases__[0]
+            storage.ShardedStorage.FLUSH_ROWS = 10000
+        self.assertEqual(
+            sharded_storage.get_all(),
+            storage.CSVStorage(TEST_DATA_CSV).get_all()
+        )
+        # two shards, so more writes mean rows were flushed before EOF
+        self.assertGreater(len(flushed), 2)
+        self.assertEqual(sum(flushed), 9)
+
+    def test_mmap_storage(self):
+        """
+        Test memory-mapped storage backend decodes users lazily.
+        """
+        csv_storage = storage.CSVStorage(TEST_DATA_CSV)
+        mmap_storage = storage.MmapCSVStorage(TEST_DATA_CSV, cache_size=1)
+        self.assertItemsEqual(mmap_storage.user_ids(), [10, 11])
+        self.assertEqual(len(mmap_storage.offsets[11]), 6)
+        self.assertEqual(len(mmap_storage.cache), 0)
+        self.assertEqual(mmap_storage.get_user(10), csv_storage.get_user(10))
+        self.assertEqual(mmap_storage.get_user(11), csv_storage.get_user(11))
+        self.assertEqual(len(mmap_storage.cache), 1)
+        self.assertEqual(mmap_storage.get_user(20), {})
+        self.assertEqual(
+            list(mmap_storage.iter_users([20, 11, 10])),
+            [(10, csv_storage.get_user(10)), (11, csv_storage.get_user(11)),
+             (20, {})]
+        )
+        self.assertEqual(mmap_storage.cache.items.keys(), [11])
+        self.assertEqual(mmap_storage.get_all(), csv_storage.get_all())
+        self.assertEqual(
+            mmap_storage.get_user(
+                11, date_to=datetime.date(2013, 9, 5)
+            ).keys(),
+            [datetime.date(2013, 9, 5)]
+        )
+
+        mmap_storage = storage.MmapCSVStorage(TEST_ANOMALIES_CSV)
+        self.assertEqual(mmap_storage.anomalies.malformed_lines, [8])
+        summary = mmap_storage.anomalies.summary()
+        self.assertEqual(
+            summary['counts'],
+            storage.CSVStorage(TEST_ANOMALIES_CSV).anomalies.summary()[
+                'counts'
+            ]
+        )
+        self.assertEqual(len(mmap_storage.cache), 0)
+        self.assertEqual(mmap_storage.anomalies.summary(), summary)
+        mmap_storage.get_user(10)
+        self.assertEqual(mmap_storage.anomalies.counts(10), {
+            'malformed': 0, 'duplicate': 1, 'overnight': 1,
+            'short': 0, 'missing': 2
+        })
+
+        path = os.path.join(self.tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'Presence report\n'
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '\n'
+                '11,2013-09-10,08:00:00,16:00:00\n'
+                'Total rows: 2'
+            )
+        mmap_storage = storage.MmapCSVStorage(path)
+        self.assertEqual(
+            dict((user_id, list(offsets)) for user_id, offsets
+                 in mmap_storage.offsets.iteritems()),
+            {10: [16], 11: [49]}
+        )
+        self.assertEqual(mmap_storage.anomalies.malformed_lines, [])
+        self.assertEqual(
+            mmap_storage.get_user(11).keys(), [datetime.date(2013, 9, 10)]
+        )
+        with open(path, 'r+') as csvfile:
+            csvfile.truncate(10)
+        with self.assertRaises(IOError):
+            mmap_storage.get_user(10)
+
+        config = {'DATA_CSV': TEST_DATA_CSV, 'STORAGE_BACKEND': 'mmap'}
+        self.assertIsInstance(
+            storage.create_storage(config), storage.CSVStorage
+        )
+        config['MMAP_MIN_SIZE'] = 0
+        self.assertIsInstance(
+            storage.create_storage(config), storage.MmapCSVStorage
+        )
+
+    def test_lru_cache(self):
+        """
+        Test LRU cache drops least recently used items.
+        """
+        cache = storage.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_storage_anomalies(self):
+        """
+        Test anomalies are detected and kept by every storage backend.
+        """
+        csv_storage = storage.CSVStorage(TEST_ANOMALIES_CSV)
+        sqlite_storage = storage.SQLiteStorage(
+            TEST_ANOMALIES_CSV, self.db_path
+        )
+        sharded_storage = storage.ShardedStorage(
+            os.path.join(self.tmp_dir, 'shards'), csv_path=TEST_ANOMALIES_CSV
+        )
+        reopened_sqlite = storage.SQLiteStorage(
+            TEST_ANOMALIES_CSV, self.db_path
+        )
+        reopened_sharded = storage.ShardedStorage(
+            os.path.join(self.tmp_dir, 'shards')
+        )
+        expected = csv_storage.anomalies.summary()
+        self.assertEqual(expected['counts']['duplicate'], 1)
+        for backend in (sqlite_storage, sharded_storage, reopened_sqlite,
+                        reopened_sharded):
+            self.assertEqual(backend.anomalies.summary(), expected)
+            for user_id in (10, 11, 20):
+                self.assertEqual(
+                    backend.anomalies.get_user(user_id),
+                    csv_storage.anomalies.get_user(user_id)
+                )
+        # anomaly lists are not kept in the index
+        self.assertEqual(
+            reopened_sharded.index['anomalies'],
+            json.loads(json.dumps(
+                anomalies.StoredAnomalies.dump(csv_storage.anomalies)
+            ))
+        )
+        self.assertEqual(
+            csv_storage.get_user(10)[datetime.date(2013, 9, 10)]['start'],
+            datetime.time(10, 0)
+        )
+
+    def test_csv_storage_refresh(self):
+        """
+        Test reading rows appended to CSV file.
+        """
+        path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        csv_storage = storage.CSVStorage(path)
+        # unchanged file is not read again
+        csv_storage.digest = None
+        self.assertEqual(csv_storage.refresh(), [])
+        # last line was incomplete
+        with open(path, 'a') as csvfile:
+            csvfile.write('0\n')
+        self.assertEqual(csv_storage.refresh(), None)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n')
+        csv_storage = storage.CSVStorage(path)
+        self.assertEqual(csv_storage.refresh(), [])
+        returned = csv_storage.get_user(10)
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '10,2013-09-13,09:00:00,17:00:00\n'
+                '10,2013-09-12,08:00:00,16:00:00\n'
+            )
+        appended = csv_storage.refresh()
+        # data returned before refresh is not changed
+        self.assertEqual(len(returned), 3)
+        self.assertEqual(appended, [
+            (
+                10, datetime.date(2013, 9, 13),
+                datetime.time(9), datetime.time(17), None
+            ),
+            (
+                10, datetime.date(2013, 9, 12),
+                datetime.time(8), datetime.time(16),
+                {
+                    'start': datetime.time(10, 48, 46),
+                    'end': datetime.time(17, 23, 51)
+                }
+            ),
+        ])
+        self.assertEqual(len(csv_storage.get_user(10)), 4)
+        self.assertEqual(csv_storage.anomalies.counts(10)['duplicate'], 1)
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-13,09:00:00,17:00:00\n' * 10)
+        self.assertIsNone(csv_storage.refresh())
+
+    def test_csv_storage_pack(self):
+        """
+        Test storage parsed in worker process is restored from its state.
+        """
+        path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_ANOMALIES_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n')
+        csv_storage = storage.CSVStorage(path)
+        state = csv_storage.pack()
+        self.assertIsInstance(state['rows'], str)
+        restored = storage.CSVStorage.unpack(state)
+        self.assertEqual(restored.data, csv_storage.data)
+        self.assertEqual(
+            restored.anomalies.summary(), csv_storage.anomalies.summary()
+        )
+        self.assertEqual(restored.anomalies.dates, csv_storage.anomalies.dates)
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-16,09:00:00,17:00:00\n')
+        self.assertEqual(len(restored.refresh()), 1)
+        self.assertEqual(
+            restored.anomalies.counts(10),
+            storage.CSVStorage(path).anomalies.counts(10)
+        )
+
+    def test_merge_sources(self):
+        """
+        Test k-way merge of several sources with conflict policies.
+        """
+        first = {
+            10: {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9), 'end': datetime.time(17)
+                },
+            },
+            11: {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(8), 'end': datetime.time(16)
+                },
+            },
+        }
+        second = {
+            10: {
+                datetime.date(2013, 9, 9): {
+                    'start': datetime.time(9), 'end': datetime.time(15)
+                },
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(10), 'end': datetime.time(18)
+                },
+            },
+        }
+        merged = list(storage.merge_sources([first, second]))
+        self.assertEqual(
+            [(user_id, date) for user_id, date, _ in merged],
+            [
+                (10, datetime.date(2013, 9, 9)),
+                (10, datetime.date(2013, 9, 10)),
+                (11, datetime.date(2013, 9, 10)),
+            ]
+        )
+        self.assertEqual(merged[1][2]['start'], datetime.time(10))
+        merged = list(storage.merge_sources([first, second], 'first'))
+        self.assertEqual(merged[1][2]['start'], datetime.time(9))
+        merged = list(storage.merge_sources([first, second], 'longest'))
+        self.assertEqual(merged[1][2]['start'], datetime.time(9))
+        merged = list(storage.merge_sources([first, second], 'union'))
+        self.assertEqual(
+            merged[1][2],
+            {'start': datetime.time(9), 'end': datetime.time(18)}
+        )
+
+    def test_multi_csv_storage(self):
+        """
+        Test merging several CSV sources and refreshing only changed ones.
+        """
+        offices = os.path.join(self.tmp_dir, 'offices')
+        os.mkdir(offices)
+        first = os.path.join(offices, 'a.csv')
+        second = os.path.join(offices, 'b.csv')
+        with open(first, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '10,2013-09-11,09:00:00,17:00:00\n'
+            )
+        with open(second, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-11,10:00:00,18:00:00\n'
+                '11,2013-09-11,08:00:00,16:00:00\n'
+            )
+        multi_storage = storage.create_storage({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_CSV_SOURCES': [os.path.join(offices, '*.csv')],
+        })
+        self.assertIsInstance(multi_storage, storage.MultiCSVStorage)
+        self.assertItemsEqual(multi_storage.user_ids(), [10, 11])
+        self.assertEqual(
+            multi_storage.get_user(10)[datetime.date(2013, 9, 11)]['start'],
+            datetime.time(10)
+        )
+        duplicates = [
+            anomaly for anomaly in multi_storage.anomalies.get_user(10)[
+                'anomalies'
+            ] if anomaly['type'] == 'duplicate'
+        ]
+        self.assertEqual(duplicates, [
+            {'type': 'duplicate', 'date': '2013-09-11', 'line': None,
+             'source': second}
+        ])
+
+        self.assertEqual(multi_storage.refresh(), [])
+        kept = multi_storage.sources[first]
+        returned = multi_storage.get_all()
+        with open(second, 'w') as csvfile:
+            csvfile.write('11,2013-09-12,08:00:00,16:00:00\n')
+        changes = multi_storage.refresh()
+        self.assertEqual(
+            returned[10][datetime.date(2013, 9, 11)]['start'],
+            datetime.time(10)
+        )
+        self.assertEqual(len(returned[11]), 1)
+        self.assertIs(multi_storage.sources[first], kept)
+        self.assertEqual(changes, [
+            (
+                10, datetime.date(2013, 9, 11),
+                datetime.time(9), datetime.time(17),
+                {'start': datetime.time(10), 'end': datetime.time(18)}
+            ),
+            (
+                11, datetime.date(2013, 9, 11), None, None,
+                {'start': datetime.time(8), 'end': datetime.time(16)}
+            ),
+            (
+                11, datetime.date(2013, 9, 12),
+                datetime.time(8), datetime.time(16), None
+            ),
+        ])
+
+        with open(os.path.join(offices, 'c.csv'), 'w') as csvfile:
+            csvfile.write('12,2013-09-12,08:00:00,16:00:00\n')
+        os.remove(second)
+        changes = multi_storage.refresh()
+        self.assertEqual(len(changes), 2)
+        self.assertItemsEqual(multi_storage.user_ids(), [10, 12])
+        self.assertEqual(multi_storage.sources.keys(), [
+            first, os.path.join(offices, 'c.csv')
+        ])
+
+        with self.assertRaises(ValueError):
+            storage.MultiCSVStorage([first], conflict='unknown')
+
+    def test_create_storage(self):
+        """
+        Test selecting storage backend from config.
+        """
+        config = {
+            'DATA_CSV': TEST_DATA_CSV,
+            'SQLITE_DB': self.db_path,
+        }
+        self.assertIsInstance(
+            storage.create_storage(config), storage.CSVStorage
+        )
+        config['STORAGE_BACKEND'] = 'sqlite'
+        self.assertIsInstance(
+            storage.create_storage(config), storage.SQLiteStorage
+        )
+        config['DATA_CSV_SOURCES'] = [TEST_DATA_CSV]
+        with self.assertRaises(ValueError):
+            storage.create_storage(config)
+        del config['DATA_CSV_SOURCES']
+        config['STORAGE_BACKEND'] = 'unknown'
+        with self.assertRaises(ValueError):
+            storage.create_storage(config)
+
+
+class PresenceAnalyzerAnomaliesTestCase(unittest.TestCase):
+    """
+    Anomaly detection tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_ANOMALIES_CSV})
+        utils.cache.clear()
+        self.client = main.load_views().test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.cache.clear()
+
+    def test_detector(self):
+        """
+        Test detecting anomalies while parsing CSV file.
+        """
+        detector = anomalies.AnomalyDetector()
+        rows = list(storage.parse_csv(TEST_ANOMALIES_CSV, detector))
+        self.assertEqual(len(rows), 5)
+        detector.finish()
+        self.assertEqual(detector.get_user(10), {
+            'counts': {
+                'malformed': 0, 'duplicate': 1, 'overnight': 1,
+                'short': 0, 'missing': 2
+            },
+            'anomalies': [
+                {'type': 'duplicate', 'date': '2013-09-10', 'line': 4},
+                {'type': 'overnight', 'date': '2013-09-13', 'line': 5},
+                {'type': 'missing', 'date': '2013-09-11', 'line': None},
+                {'type': 'missing', 'date': '2013-09-12', 'line': None},
+            ]
+        })
+        self.assertEqual(detector.get_user(11), {
+            'counts': {
+                'malformed': 1, 'duplicate': 0, 'overnight': 0,
+                'short': 1, 'missing': 0
+            },
+            'anomalies': [
+                {'type': 'short', 'date': '2013-09-09', 'line': 6},
+                {'type': 'malformed', 'date': None, 'line': 7},
+            ]
+        })
+        self.assertEqual(detector.malformed_lines, [8])
+
+        restored = anomalies.AnomalyDetector.from_dict(
+            json.loads(json.dumps(detector.to_dict()))
+        )
+        self.assertEqual(restored.summary(), detector.summary())
+
+    def test_anomalies_api(self):
+        """
+        Test user anomalies api responses.
+        """
+        resp = self.client.get('/api/v1/anomalies/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['counts']['short'], 1)
+        self.assertEqual(len(data['anomalies']), 2)
+        resp = self.client.get('/api/v1/anomalies/20')
+        self.assertEqual(resp.data, '404')
+
+    def test_anomalies_summary_api(self):
+        """
+        Test company anomalies summary api responses.
+        """
+        resp = self.client.get('/api/v1/anomalies')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['counts'], {
+            'malformed': 2, 'duplicate': 1, 'overnight': 1,
+            'short': 1, 'missing': 2
+        })
+        self.assertItemsEqual(data['users'].keys(), ['10', '11'])
+        self.assertEqual(data['malformed_lines'], [8])
+
+
+class PresenceAnalyzerWatcherTestCase(unittest.TestCase):
+    """
+    Data source watcher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        self.write('10,2013-09-10,09:39:05,17:59:52\n')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, content):
+        """
+        Replaces content of watched file.
+        """
+        with open(self.path, 'w') as data_file:
+            data_file.write(content)
+
+    def wait_for_version(self, data_watcher, version):
+        """
+        Waits up to one second for watcher to reach given version.
+        """
+        for _ in range(100):
+            if data_watcher.version >= version:
+                break
+            time.sleep(0.01)
+        return data_watcher.version
+
+    def test_check(self):
+        """
+        Test synchronous checks bump version only on changes.
+        """
+        data_watcher = watcher.DataSourceWatcher(lambda: [self.path])
+        self.assertEqual(data_watcher.get_version(), 1)
+        self.assertEqual(data_watcher.get_version(), 1)
+        self.write('10,2013-09-10,09:39:05,17:59:52\n' * 2)
+        self.assertEqual(data_watcher.get_version(), 2)
+        os.remove(self.path)
+        self.assertEqual(data_watcher.get_version(), 3)
+        self.assertEqual(data_watcher.get_version(), 3)
+
+    def test_watching_thread(self):
+        """
+        Test watching thread bumps version once after burst of writes.
+        """
+        data_watcher = watcher.DataSourceWatcher(
+            lambda: [self.path], debounce=0.1, poll_interval=0.05
+        )
+        data_watcher.start()
+        try:
+            self.assertEqual(self.wait_for_version(data_watcher, 1), 1)
+            for i in range(5):
+                self.write('10,2013-09-10,09:39:05,17:59:52\n' * (i + 2))
+                time.sleep(0.02)
+            self.assertEqual(self.wait_for_version(data_watcher, 2), 2)
+            time.sleep(0.2)
+            self.assertEqual(data_watcher.get_version(), 2)
+        finally:
+            data_watcher.stop()
+        self.assertFalse(data_watcher.running)
+
+
+class PresenceAnalyzerAssetsTestCase(unittest.TestCase):
+    """
+    Static assets tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.static_folder = main.app.static_folder
+        self.tmp_dir = tempfile.mkdtemp()
+        main.app.static_folder = os.path.join(self.tmp_dir, 'static')
+        shutil.copytree(self.static_folder, main.app.static_folder)
+        utils.cache.clear()
+        self.client = main.load_views().test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.static_folder = self.static_folder
+        shutil.rmtree(self.tmp_dir)
+        utils.cache.clear()
+
+    def test_static_url(self):
+        """
+        Test fingerprinted static files URLs in rendered pages.
+        """
+        manifest = helpers.get_asset_manifest()
+        self.assertItemsEqual(manifest.keys(), [
+            'css/base.css', 'css/normalize.css', 'img/loading.gif',
+            'js/jquery.min.js'
+        ])
+        self.assertRegexpMatches(
+            manifest['css/base.css'], r'^css/base\.[0-9a-f]{12}\.css$'
+        )
+        resp = self.client.get('render/presence_weekday')
+        self.assertIn('/assets/' + manifest['js/jquery.min.js'], resp.data)
+        self.assertNotIn('/static/', resp.data)
+        with main.load_views().test_request_context():
+            self.assertEqual(
+                helpers.static_url('missing.css'), '/static/missing.css'
+            )
+
+    def test_asset_view(self):
+        """
+        Test serving fingerprinted and gzipped static files.
+        """
+        fingerprinted = helpers.get_asset_manifest()['css/base.css']
+        resp = self.client.get('/assets/' + fingerprinted)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertNotIn('Content-Encoding', resp.headers)
+        with open(os.path.join(main.app.static_folder, 'css', 'base.css')) \
+                as source:
+            content = source.read()
+        self.assertEqual(resp.data, content)
+
+        helpers.build_assets(main.app.static_folder)
+        self.assertTrue(os.path.exists(os.path.join(
+            main.app.static_folder, 'js', 'jquery.min.js.gz'
+        )))
+        self.assertFalse(os.path.exists(os.path.join(
+            main.app.static_folder, 'img', 'loading.gif.gz'
+        )))
+        resp = self.client.get(
+            '/assets/' + fingerprinted, headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        compressed = os.path.join(self.tmp_dir, 'base.css.gz')
+        with open(compressed, 'wb') as output:
+            output.write(resp.data)
+        self.assertEqual(gzip.open(compressed).read(), content)
+
+        resp = self.client.get('/assets/css/base.css')
+        self.assertEqual(resp.status_code, 404)
+
+
+class PresenceAnalyzerWarmupTestCase(unittest.TestCase):
+    """
+    Cache warm-up tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.extensions.pop('cache_warmer', None)
+        self.client = main.load_views().test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.extensions.pop('cache_warmer', None)
+
+    def test_run(self):
+        """
+        Test warm-up calls every function for every user.
+        """
+        calls = []
+        warmer = warmup.CacheWarmer(
+            [lambda user_id: calls.append(('a', user_id)),
+             lambda user_id: calls.append(('b', user_id))],
+            workers=2
+        )
+        warmer.run([10, 11])
+        self.assertItemsEqual(
+            calls, [('a', 10), ('b', 10), ('a', 11), ('b', 11)]
+        )
+
+    def test_select_users(self):
+        """
+        Test warm-up of most requested users.
+        """
+        warmer = warmup.CacheWarmer([], top_n=2)
+        self.assertEqual(warmer.select_users([10, 11, 12]), [10, 11, 12])
+        for user_id in (12, 12, 11, 12, 11, 10, 13, 13, 13, 13):
+            warmer.record_request(user_id)
+        self.assertEqual(warmer.select_users([10, 11, 12]), [12])
+        warmer.top_n = 3
+        self.assertEqual(warmer.select_users([10, 11, 12]), [12, 11])
+
+    def test_start(self):
+        """
+        Test background warm-up is retried until it succeeds.
+        """
+        function = Mock(side_effect=[ValueError, ValueError, None])
+        warmer = warmup.CacheWarmer([function], retry_delay=0.01)
+        warmer.start(lambda: [10])
+        self.assertTrue(warmer.ready.wait(1))
+        self.assertEqual(function.call_count, 3)
+        for _ in range(100):
+            if not warmer.running:
+                break
+            time.sleep(0.01)
+        self.assertFalse(warmer.running)
+
+    def test_health(self):
+        """
+        Test health check fails until cache is warmed up.
+        """
+        resp = self.client.get('/health')
+        self.assertEqual(resp.status_code, 503)
+        utils.warm_up()
+        self.assertTrue(utils.get_warmer().ready.wait(5))
+        resp = self.client.get('/health')
+        self.assertEqual(resp.status_code, 200)
+        cached = utils.cache.copy()
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(utils.get_warmer().requests[10], 1)
+        self.assertEqual(cached, utils.cache)
+
+    def test_watcher_listeners(self):
+        """
+        Test watcher notifies listeners about new versions.
+        """
+        versions = []
+        data_watcher = watcher.DataSourceWatcher(lambda: [TEST_DATA_CSV])
+        data_watcher.listeners.append(versions.append)
+        data_watcher.get_version()
+        data_watcher.get_version()
+        self.assertEqual(versions, [1])
+
+
+class PresenceAnalyzerCoalesceTestCase(unittest.TestCase):
+    """
+    Request coalescing tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.client = main.load_views().test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def run_threads(self, target, args_list):
+        """
+        Runs target in thread for every args, returns results in order.
+        """
+        results = [None] * len(args_list)
+
+        def run(i, args):
+            """
+            Stores result of single thread.
+            """
+            try:
+                results[i] = target(*args)
+            except ValueError as error:
+                results[i] = error
+
+        threads = [
+            threading.Thread(target=run, args=(i, args))
+            for i, args in enumerate(args_list)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_call(self):
+        """
+        Test concurrent identical calls share single computation.
+        """
+        coalescer = coalesce.RequestCoalescer()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            """
+            Blocks until all callers have joined.
+            """
+            calls.append(1)
+            release.wait(1)
+            return 42
+
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        results = self.run_threads(
+            coalescer.call, [('key', compute)] * 5
+        )
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(len(calls), 1)
+        stats = coalescer.stats()
+        self.assertEqual(stats['calls'], 5)
+        self.assertEqual(stats['computations'], 1)
+        self.assertEqual(stats['coalescing_ratio'], 5.0)
+
+        self.assertRaises(
+            ValueError, coalescer.call, 'key', Mock(side_effect=ValueError)
+        )
+        self.assertEqual(coalescer.call('key', lambda: 1), 1)
+
+    def test_load(self):
+        """
+        Test users requested at the same time are loaded in one batch.
+        """
+        coalescer = coalesce.RequestCoalescer(window=0.1)
+        load_many = Mock(side_effect=lambda user_ids: {
+            user_id: {'user': user_id} for user_id in user_ids if user_id
+        })
+
+        started = []
+        all_started = threading.Event()
+
+        def compute(user_id):
+            """
+            Loads user once computations of all users are running.
+            """
+            started.append(user_id)
+            if len(started) == 3:
+                all_started.set()
+            all_started.wait(1)
+            return coalescer.load(user_id, load_many)
+
+        def request(user_id):
+            """
+            Loads user inside running computation.
+            """
+            return coalescer.call(user_id, lambda: compute(user_id))
+
+        results = self.run_threads(request, [(10,), (11,), (10,), (0,)])
+        self.assertEqual(
+            results, [{'user': 10}, {'user': 11}, {'user': 10}, {}]
+        )
+        self.assertEqual(load_many.call_count, 1)
+        self.assertItemsEqual(load_many.call_args[0][0], [0, 10, 11])
+        stats = coalescer.stats()
+        self.assertEqual(stats['batches'], 1)
+
+        # single request is not delayed
+        with patch('presence_analyzer.coalesce.time') as coalesce_time:
+            self.assertEqual(coalescer.load(12, load_many), {'user': 12})
+        self.assertFalse(coalesce_time.sleep.called)
+
+    def test_coalescing_view(self):
+        """
+        Test coalescing counters.
+        """
+        resp = self.client.get('/api/v1/coalescing')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        for name in ('calls', 'computations', 'coalescing_ratio',
+                     'loads', 'batches', 'batching_ratio'):
+            self.assertIn(name, data)
+
+
+class PresenceAnalyzerGenerateDataTestCase(unittest.TestCase):
+    """
+    Synthetic data generator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def generate(self, *args):
+        """
+        Runs generator with given arguments, returns generated CSV.
+        """
+        path = os.path.join(self.tmp_dir, 'data.csv')
+        generate_data.generate(['-o', path] + list(args))
+        with open(path) as csvfile:
+            return csvfile.read()
+
+    def test_iter_rows(self):
+        """
+        Test generated rows are ordered by user and date.
+        """
+        rows = list(generate_data.iter_rows(
+            random.Random(0), [10, 11],
+            datetime.date(2013, 9, 2), datetime.date(2013, 9, 29),
+            arrival='uniform', absence_rate=0, weekend_rate=0
+        ))
+        self.assertEqual(len(rows), 40)
+        self.assertEqual(rows, sorted(rows))
+        for _, date, start, end in rows:
+            self.assertLess(date.weekday(), 5)
+            self.assertTrue(
+                9 * 3600 - 90 * 60 <= start <= 9 * 3600 + 90 * 60
+            )
+            self.assertTrue(start <= end < 24 * 3600)
+
+    def test_generate(self):
+        """
+        Test generated data depends only on seed and can be loaded.
+        """
+        content = self.generate('--users', '5', '--years', '0.5')
+        self.assertEqual(
+            content, self.generate('--users', '5', '--years', '0.5')
+        )
+        self.assertNotEqual(
+            content,
+            self.generate('--users', '5', '--years', '0.5', '--seed', '1')
+        )
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'Presence report')
+        self.assertEqual(lines[-1], 'Total rows: %d' % (len(lines) - 2))
+
+        xml_path = os.path.join(self.tmp_dir, 'users.xml')
+        content = self.generate(
+            '--users', '3', '--xml', xml_path, '--malformed-rate', '0.5'
+        )
+        detector = anomalies.AnomalyDetector()
+        rows = list(storage.parse_lines(content.splitlines(), detector))
+        self.assertItemsEqual(set(row[0] for row in rows), [10, 11, 12])
+        malformed = detector.summary()['counts']['malformed']
+        self.assertGreater(malformed, 0)
+        # lines with missing field are skipped without being reported
+        self.assertLess(malformed + len(rows), len(content.splitlines()) - 2)
+
+        main.app.config.update({'DATA_XML': xml_path})
+        utils.cache.clear()
+        self.assertEqual(
+            sorted(user['user_id'] for user in views.get_users()),
+            [10, 11, 12]
+        )
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        utils.cache.clear()
+
+
+class PresenceAnalyzerStartupTestCase(unittest.TestCase):
+    """
+    Startup tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+        if self.tmp_dir in sys.path:
+            sys.path.remove(self.tmp_dir)
+
+    def test_lazy_views(self):
+        """
+        Test application can be imported without views.
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, presence_analyzer.main; '
+            'print sorted(set(sys.modules) & set(["lxml", "mako", '
+            '"presence_analyzer.views", "presence_analyzer.urls"]))'
+        ], env=env)
+        self.assertEqual(output.strip(), '[]')
+
+    def test_trace(self):
+        """
+        Test import time report.
+        """
+        package = os.path.join(self.tmp_dir, 'startup_pkg')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as module:
+            module.write('from . import heavy\n')
+        with open(os.path.join(package, 'heavy.py'), 'w') as module:
+            module.write('import time\ntime.sleep(0.02)\n')
+        sys.path.insert(0, self.tmp_dir)
+        output = StringIO()
+        report = importtime.trace('startup_pkg', output)
+        self.assertEqual(
+            [name for _, _, name in report],
+            ['  startup_pkg.heavy', 'startup_pkg']
+        )
+        self.assertGreaterEqual(report[0][1], 20000)
+        self.assertGreaterEqual(report[1][1], report[0][1])
+        self.assertLess(report[1][0], report[0][1])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], importtime.HEADER)
+        self.assertTrue(lines[1].endswith('|   startup_pkg.heavy'))
+
+    def test_benchmark(self):
+        """
+        Test startup benchmark.
+        """
+        output = StringIO()
+        results = importtime.benchmark(['presence_analyzer'], 2, output)
+        self.assertEqual(len(results['presence_analyzer']), 2)
+        self.assertIn('presence_analyzer', output.getvalue())
+
+
+class PresenceAnalyzerUsersTestCase(unittest.TestCase):
+    """
+    Users registry tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        names = [
+            'Żaneta A.', 'Zenon D.', 'Łukasz B.', 'Lucyna C.', 'Ćwik E.',
+            'Cezary F.', 'adam G.', 'Adam G.', 'Émile H.', 'Emil H.',
+        ]
+        self.registry = users.UsersRegistry([
+            {'user_id': i, 'name': name, 'avatar': ''}
+            for i, name in enumerate(names)
+        ])
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def names(self, *args):
+        """
+        Returns names of users returned by registry.
+        """
+        return [user['name'] for user in self.registry.get_users(*args)]
+
+    def test_collation(self):
+        """
+        Test users are sorted by Polish alphabet.
+        """
+        self.assertEqual(self.names(), [
+            'adam G.', 'Adam G.', 'Cezary F.', 'Ćwik E.', 'Emil H.',
+            'Émile H.', 'Lucyna C.', 'Łukasz B.', 'Zenon D.', 'Żaneta A.',
+        ])
+        self.assertEqual(self.names('surname')[:3], [
+            'Żaneta A.', 'Łukasz B.', 'Lucyna C.'
+        ])
+        self.assertEqual(self.names('id')[:2], ['Żaneta A.', 'Zenon D.'])
+        self.assertRaises(ValueError, self.registry.get_users, 'unknown')
+
+    def test_search(self):
+        """
+        Test name prefix search ignoring case and accents.
+        """
+        self.assertEqual(self.names('name', 'lu'), ['Lucyna C.', 'Łukasz B.'])
+        self.assertEqual(self.names('name', 'ŁUK'), ['Łukasz B.'])
+        self.assertEqual(self.names('id', 'emil'), ['Émile H.', 'Emil H.'])
+        self.assertEqual(self.names('name', 'emil h.'), [
+            'Emil H.', 'Émile H.'
+        ])
+        self.assertEqual(self.names('name', 'x'), [])
+        self.assertEqual(len(self.names('name', ' ')), 10)
+
+    def test_search_scan(self):
+        """
+        Test prefix search in large registry does not scan all names.
+        """
+        rng = random.Random(0)
+        registry = users.UsersRegistry([
+            {
+                'user_id': i,
+                'name': '%s %s.' % (
+                    rng.choice(generate_data.FIRST_NAMES),
+                    chr(ord('A') + rng.randrange(26))
+                ),
+                'avatar': '',
+            }
+            for i in range(10000)
+        ])
+        accessed = []
+
+        class CountingList(list):
+            """
+            List counting accessed items.
+            """
+
+            def __getitem__(self, index):
+                accessed.append(index)
+                return list.__getitem__(self, index)
+
+        registry.prefix_words = CountingList(registry.prefix_words)
+        found = registry.search('mar k')
+        self.assertEqual(found, set(
+            i for i, user in enumerate(registry.users)
+            if user['name'].startswith('Mar') and ' K' in user['name']
+        ))
+        # two binary searches per query word
+        self.assertLess(len(accessed), 4 * 2 * 16)
+
+
+class PresenceAnalyzerScriptTestCase(unittest.TestCase):
+    """
+    Serving scripts tests.
+    """
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.extensions.pop('reload_executor', None)
+
+    def serve(self, action, **kwargs):
+        """
+        Returns argv passed to paster by given serve action.
+        """
+        paste = Mock()
+        modules = {
+            'paste': paste,
+            'paste.script': paste.script,
+            'paste.script.command': paste.script.command,
+        }
+        with patch.dict(sys.modules, modules), \
+                patch.object(sys, 'argv', []), \
+                patch.object(sys, 'stdout', StringIO()):
+            script._serve(action, **kwargs)
+            self.assertTrue(paste.script.command.run.called)
+            return sys.argv
+
+    def test_serve(self):
+        """
+        Test paster command lines.
+        """
+        self.assertEqual(self.serve('fg'), [
+            'bin/paster', 'serve', script.abspath(script.DEPLOY_INI),
+            '--reload',
+        ])
+        self.assertEqual(self.serve('fg', async_mode=True), [
+            'bin/paster', 'serve', script.abspath(script.ASYNC_INI),
+        ])
+        self.assertEqual(
+            self.serve('start', async_mode=True)[:5], [
+                'bin/paster', 'serve', script.abspath(script.ASYNC_INI),
+                'start', '--daemon',
+            ]
+        )
+
+    def test_serve_gevent(self):
+        """
+        Test gevent server hands reloads off to thread pool.
+        """
+        gevent = Mock()
+        modules = {
+            'gevent': gevent,
+            'gevent.monkey': gevent.monkey,
+            'gevent.pool': gevent.pool,
+            'gevent.pywsgi': gevent.pywsgi,
+        }
+        wsgi_app = Mock()
+        with patch.dict(sys.modules, modules):
+            gevent.monkey.is_module_patched.return_value = False
+            with self.assertRaises(RuntimeError):
+                script.serve_gevent(wsgi_app)
+            self.assertNotIn('reload_executor', main.app.extensions)
+            self.assertFalse(gevent.pywsgi.WSGIServer.called)
+
+            gevent.monkey.is_module_patched.return_value = True
+            script.serve_gevent(wsgi_app, port='8081', connections='5')
+        gevent.monkey.is_module_patched.assert_called_with('threading')
+        gevent.pool.Pool.assert_called_once_with(5)
+        gevent.pywsgi.WSGIServer.assert_called_once_with(
+            ('0.0.0.0', 8081), wsgi_app, spawn=gevent.pool.Pool.return_value
+        )
+        self.assertTrue(
+            gevent.pywsgi.WSGIServer.return_value.serve_forever.called
+        )
+
+        threadpool = gevent.get_hub.return_value.threadpool
+        threadpool.apply.return_value = 'reloaded'
+        function = Mock()
+        self.assertEqual(
+            utils.run_reload(function, 'a', 'b'), 'reloaded'
+        )
+        threadpool.apply.assert_called_once_with(function, ('a', 'b'))
+        self.assertFalse(function.called)
+
+
 def suite():
     """
     Default test suite.
@@ -300,6 +1966,18 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAnomaliesTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWatcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAssetsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWarmupTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCoalesceTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerGenerateDataTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStartupTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerScriptTestCase))
     return base_suite
 
 
@@ -5,7 +5,7 @@ import os
 import urllib2
 import logging
 
-from presence_analyzer import app
+from presence_analyzer.main import app
 
 
 def update():
@@ -3,12 +3,22 @@ from presence_analyzer import views
 
 
 app.add_url_rule('/', 'index', view_func=views.mainpage)
+app.add_url_rule('/health', 'health', view_func=views.health_view)
 
 app.add_url_rule('/api/v1/users', 'users', view_func=views.users_view)
 app.add_url_rule(
     '/api/v1/mean_time_weekday/<int:user_id>', 'time_weekday',
     view_func=views.mean_time_weekday_view
 )
+app.add_url_rule(
+    '/api/v1/median_time_weekday/<int:user_id>', 'median_time_weekday',
+    view_func=views.percentile_time_weekday_view
+)
+app.add_url_rule(
+    '/api/v1/percentile_time_weekday/<int:user_id>/<int(max=100):percent>',
+    'percentile_time_weekday',
+    view_func=views.percentile_time_weekday_view
+)
 app.add_url_rule(
     '/api/v1/presence_weekday/<int:user_id>', 'presence_weekday',
     view_func=views.presence_weekday_view
@@ -17,10 +27,52 @@ app.add_url_rule(
     '/api/v1/presence_from_to/<int:user_id>', 'presence_from_to',
     view_func=views.presence_from_to_view
 )
+app.add_url_rule(
+    '/api/v1/median_from_to/<int:user_id>', 'median_from_to',
+    view_func=views.percentile_from_to_view
+)
+app.add_url_rule(
+    '/api/v1/percentile_from_to/<int:user_id>/<int(max=100):percent>',
+    'percentile_from_to',
+    view_func=views.percentile_from_to_view
+)
+app.add_url_rule(
+    '/api/v1/presence_histogram/<int:user_id>', 'presence_histogram',
+    view_func=views.presence_histogram_view
+)
 app.add_url_rule(
     '/api/v1/monthly_hours/<int:user_id>', 'monthly_hours',
     view_func=views.monthly_hours_view
 )
+app.add_url_rule(
+    '/api/v1/rollup/<any(week, month, year):granularity>/<int:user_id>',
+    'rollup',
+    view_func=views.rollup_view
+)
+app.add_url_rule(
+    '/api/v1/rollup/<any(week, month, year):granularity>', 'company_rollup',
+    view_func=views.company_rollup_view
+)
+app.add_url_rule(
+    '/api/v1/anomalies', 'anomalies_summary',
+    view_func=views.anomalies_summary_view
+)
+app.add_url_rule(
+    '/api/v1/anomalies/<int:user_id>', 'anomalies',
+    view_func=views.anomalies_view
+)
+app.add_url_rule(
+    '/api/v1/coalescing', 'coalescing',
+    view_func=views.coalescing_view
+)
+app.add_url_rule(
+    '/api/v1/export', 'export',
+    view_func=views.export_view
+)
+app.add_url_rule(
+    '/assets/<path:filename>', 'asset',
+    view_func=views.asset_view
+)
 app.add_url_rule(
     '/render/<template>', 'render',
     view_func=views.render_page_user
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Users registry read from XML file, with precomputed orderings and name
+prefix search.
+"""
+import unicodedata
+from bisect import bisect_left
+
+from lxml import etree
+
+
+# Polish alphabet, letters missing from it sort by their base letter
+ALPHABET = u'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+WEIGHTS = {letter: weight for weight, letter in enumerate(ALPHABET)}
+
+
+def collation_key(text):
+    """
+    Returns sort key of text following Polish alphabet, independent of
+    process locale. Like in ICU, letters are compared first, then accents
+    of letters outside Polish alphabet, then case (lowercase first).
+    Spaces and punctuation sort before digits, digits before letters.
+    """
+    primary, accents, cases = [], [], []
+    for char in unicode(text):
+        lower = char.lower()
+        accent = u''
+        if lower in WEIGHTS:
+            weight = (2, WEIGHTS[lower])
+        else:
+            decomposed = unicodedata.normalize('NFD', lower)
+            base, accent = decomposed[:1], decomposed[1:]
+            if base in WEIGHTS:
+                weight = (2, WEIGHTS[base])
+            elif base.isdigit():
+                weight = (1, ord(base))
+            elif base.isalpha():
+                weight = (3, ord(base))
+            else:
+                weight = (0, ord(base))
+        primary.append(weight)
+        accents.append(accent)
+        cases.append(char != lower)
+    return tuple(primary), tuple(accents), tuple(cases)
+
+
+def get_sort_key():
+    """
+    Returns function computing Polish collation keys: ICU collator if
+    PyICU is installed, collation_key otherwise.
+    """
+    try:
+        import icu
+    except ImportError:
+        return collation_key
+    collator = icu.Collator.createInstance(icu.Locale('pl_PL'))
+    return lambda text: collator.getSortKey(unicode(text))
+
+
+def fold(text):
+    """
+    Returns lowercase text without accents, used for prefix search.
+    """
+    decomposed = unicodedata.normalize('NFD', unicode(text).lower())
+    return u''.join(
+        char for char in decomposed if not unicodedata.combining(char)
+    ).replace(u'ł', u'l')
+
+
+def surname(name):
+    """
+    Returns last word of user's name.
+    """
+    words = name.split()
+    return words[-1] if words else u''
+
+
+class UsersRegistry(object):
+    """
+    Users sorted once per load in every supported order, with sorted
+    index of folded name words for prefix search.
+    """
+
+    def __init__(self, users, avatar_host=None, sort_key=None):
+        sort_key = sort_key or get_sort_key()
+        self.users = users
+        self.avatar_host = avatar_host
+        name_keys = [sort_key(user['name']) for user in users]
+        surname_keys = [sort_key(surname(user['name'])) for user in users]
+        indexes = range(len(users))
+        self.orders = {
+            'name': sorted(indexes, key=lambda i: (
+                name_keys[i], users[i]['user_id']
+            )),
+            'surname': sorted(indexes, key=lambda i: (
+                surname_keys[i], name_keys[i], users[i]['user_id']
+            )),
+            'id': sorted(indexes, key=lambda i: users[i]['user_id']),
+        }
+        self.ranks = {}
+        for order, ordered in self.orders.iteritems():
+            ranks = [0] * len(users)
+            for rank, i in enumerate(ordered):
+                ranks[i] = rank
+            self.ranks[order] = ranks
+        self.prefixes = sorted(
+            (fold(word), i)
+            for i, user in enumerate(users) for word in user['name'].split()
+        )
+        self.prefix_words = [word for word, _ in self.prefixes]
+
+    @classmethod
+    def from_xml(cls, path, sort_key=None):
+        """
+        Reads users and avatars server address from XML file.
+        """
+        root = etree.parse(path).getroot()
+        users = [
+            {
+                'user_id': int(user.get('id')),
+                'name': user.find('name').text,
+                'avatar': user.find('avatar').text
+            }
+            for user in root.find('users')
+        ]
+        server = root.find('server')
+        avatar_host = ''.join([
+            server.find('protocol').text, '://',
+            server.find('host').text, ':', server.find('port').text
+        ])
+        return cls(users, avatar_host, sort_key)
+
+    def search(self, query):
+        """
+        Returns indexes of users having name word starting with every word
+        of query, ignoring case and accents.
+        """
+        matched = None
+        for word in fold(query).split():
+            start = bisect_left(self.prefix_words, word)
+            end = bisect_left(self.prefix_words, word + u'\uffff', start)
+            found = set(i for _, i in self.prefixes[start:end])
+            matched = found if matched is None else matched & found
+        if matched is None:
+            return range(len(self.users))
+        return matched
+
+    def get_users(self, order='name', query=None):
+        """
+        Returns users in given order, limited to names matching query.
+        """
+        if order not in self.orders:
+            raise ValueError('Unknown users order: %s' % order)
+        if query:
+            indexes = sorted(
+                self.search(query), key=self.ranks[order].__getitem__
+            )
+        else:
+            indexes = self.orders[order]
+        return [self.users[i] for i in indexes]
@@ -3,23 +3,29 @@
 Helper functions used in views.
 """
 
-import csv
 import logging
 import time
 from json import dumps
 from threading import Lock
 from functools import wraps
-from datetime import datetime
 import calendar
 
 from flask import Response
 
+from presence_analyzer.coalesce import RequestCoalescer
 from presence_analyzer.main import app
+from presence_analyzer.rollups import (
+    Rollups, user_buckets, monthly_hours_table
+)
+from presence_analyzer.storage import create_storage, resolve_sources
+from presence_analyzer.warmup import CacheWarmer
+from presence_analyzer.watcher import DataSourceWatcher
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 cache = {}
 lck = Lock()
+storage_lock = Lock()
 
 
 def get_key(function, *args, **kw):
@@ -32,23 +38,82 @@ def get_key(function, *args, **kw):
     return '%s::%s::%s' % (key, hash_args, hash_kw)
 
 
-def memorize(age, storage=cache):
+def data_sources():
+    """
+    Returns paths of files presence data is read from.
+    """
+    sources = app.config.get('DATA_CSV_SOURCES')
+    if sources:
+        return resolve_sources(sources) + [app.config.get('DATA_XML')]
+    return [app.config.get('DATA_CSV'), app.config.get('DATA_XML')]
+
+
+def get_watcher():
+    """
+    Returns watcher of application data sources.
+    """
+    watcher = app.extensions.get('data_watcher')
+    if watcher is None:
+        watcher = app.extensions.setdefault(
+            'data_watcher',
+            DataSourceWatcher(
+                data_sources,
+                debounce=app.config.get('WATCH_DEBOUNCE', 1.0),
+                poll_interval=app.config.get('WATCH_POLL_INTERVAL', 2.0),
+            )
+        )
+    return watcher
+
+
+def dataset_version():
+    """
+    Returns version of data sources, increased every time they change.
+    """
+    return get_watcher().get_version()
+
+
+def get_coalescer():
+    """
+    Returns coalescer of concurrent computations and user data loads.
+    """
+    coalescer = app.extensions.get('request_coalescer')
+    if coalescer is None:
+        coalescer = app.extensions.setdefault(
+            'request_coalescer',
+            RequestCoalescer(window=app.config.get('COALESCE_WINDOW', 0.002))
+        )
+    return coalescer
+
+
+def memorize(age, storage=cache, versioned=False):
     """
     Memorizing decorator for caching purposes.
+
+    Versioned values are kept until dataset version changes instead of
+    expiring after given age. Concurrent calls missing the cache share
+    single computation.
     """
     def _memorize(function):
         def __memorize(*args, **kwargs):
             key = get_key(function, *args, **kwargs)
+            stamp = dataset_version() if versioned else time.time()
             try:
-                value_age, value = storage[key]
-                expired = (age != 0 and (value_age+age) < time.time())
+                value_stamp, value = storage[key]
+                if versioned:
+                    expired = value_stamp != stamp
+                else:
+                    expired = (age != 0 and (value_stamp+age) < stamp)
             except KeyError:
                 expired = True
             if not expired:
                 with lck:
                     return value
-            storage[key] = time.time(), function(*args, **kwargs)
-            return storage[key][1]
+            value = get_coalescer().call(
+                (key, stamp if versioned else None),
+                lambda: function(*args, **kwargs)
+            )
+            storage[key] = stamp, value
+            return value
         return __memorize
     return _memorize
 
@@ -69,10 +134,80 @@ def jsonify(function):
     return inner
 
 
-@memorize(600)
+def run_reload(function, *args):
+    """
+    Runs data reload using executor registered by serving mode (gevent
+    serving mode hands reloads off to a thread pool), or directly.
+    """
+    executor = app.extensions.get('reload_executor')
+    if executor is None:
+        return function(*args)
+    return executor(function, *args)
+
+
+def get_storage():
+    """
+    Returns presence data storage backend selected in config.
+
+    Storage is created again when dataset version changes, unless it can
+    refresh itself (rows only appended to the CSV file, or some of several
+    CSV sources changed) - then just the changed rows are applied to
+    already built rollups.
+    """
+    version = dataset_version()
+    settings = (
+        app.config.get('STORAGE_BACKEND'), app.config['DATA_CSV'],
+        tuple(app.config.get('DATA_CSV_SOURCES') or ()),
+        app.config.get('DATA_CONFLICT_POLICY'),
+    )
+    with storage_lock:
+        state = app.extensions.setdefault('presence_data', {})
+        if state.get('version') == version:
+            return state['storage']
+        storage = state.get('storage')
+        appended = None
+        if state.get('settings') == settings and hasattr(storage, 'refresh'):
+            appended = run_reload(storage.refresh)
+        if appended is None:
+            state.update(
+                storage=run_reload(create_storage, app.config),
+                rollups=None,
+                settings=settings,
+            )
+        elif state['rollups'] is not None:
+            state['rollups'] = state['rollups'].apply(appended)
+        state['version'] = version
+        return state['storage']
+
+
+def get_rollups():
+    """
+    Returns weekly, monthly and yearly rollups of presence data, built
+    once per loaded storage. Rollups of every user are kept only for
+    storages holding whole data in memory anyway.
+
+    Rollups are built outside of storage lock, by one request at a time,
+    and kept only if dataset has not changed in the meantime.
+    """
+    storage = get_storage()
+    with storage_lock:
+        state = app.extensions['presence_data']
+        if state['rollups'] is not None:
+            return state['rollups']
+        version = state['version']
+    rollups = get_coalescer().call(
+        ('rollups', version),
+        lambda: run_reload(Rollups.build, storage, storage.in_memory)
+    )
+    with storage_lock:
+        if state['version'] == version and state['rollups'] is None:
+            state['rollups'] = rollups
+    return rollups
+
+
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Returns presence data of all users grouped by user_id.
 
     It creates structure like this:
     data = {
@@ -88,25 +223,26 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return get_storage().get_all()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def get_user_data(user_id, date_from=None, date_to=None):
+    """
+    Returns presence data of given user, optionally limited to date range.
 
-    return data
+    Whole histories of users requested at the same time are loaded from
+    storage in one batch.
+    """
+    if date_from is not None or date_to is not None:
+        return get_storage().get_user(user_id, date_from, date_to)
+    return get_coalescer().load(user_id, get_storage().get_users)
+
+
+def get_anomalies():
+    """
+    Returns anomalies detected while presence data was being loaded.
+    """
+    return get_storage().anomalies
 
 
 def group_by_weekday(items):
@@ -121,20 +257,25 @@ def group_by_weekday(items):
     return result
 
 
-def usual_presence_time(items):
+def usual_presence_time(items, statistic=None):
     """
     Returns list of start and end times for each day of work.
+
+    Times are aggregated with given statistic, arithmetic mean by default.
     """
+    statistic = statistic or mean
     user_week = {i: {'start': [], 'end': []} for i in range(7)}
     for dt in items:
         user_week[dt.weekday()]['start'].append(items[dt]['start'])
         user_week[dt.weekday()]['end'].append(items[dt]['end'])
     return {
         day: {
-            'start': mean(
+            'start': statistic(
                 map(seconds_since_midnight, user_week[day]['start'])
             ),
-            'end': mean(map(seconds_since_midnight, user_week[day]['end']))
+            'end': statistic(
+                map(seconds_since_midnight, user_week[day]['end'])
+            )
         } for day in user_week
     }
 
@@ -160,47 +301,182 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
-def _get_years_and_months_total_hours(items):
+def percentile(items, percent):
     """
-    Returns a dict with each year and corresponding month with
-    a list of worked hours per day.
+    Calculates given percentile with linear interpolation between closest
+    ranks. Returns zero for empty lists.
     """
-    years = {}
-    for date, times in items.iteritems():
-        years.setdefault(date.year, {})
-        years[date.year].setdefault(date.month, [])
-        years[date.year][date.month].append(
-            interval(times['start'], times['end'])
-        )
+    if not items:
+        return 0
+    values = sorted(items)
+    position = (len(values) - 1) * percent / 100.0
+    k = int(position)
+    if position == k:
+        return float(values[k])
+    return values[k] + (values[k + 1] - values[k]) * (position - k)
+
+
+def median(items):
+    """
+    Calculates median. Returns zero for empty lists.
+    """
+    return percentile(items, 50)
+
+
+def histogram(items, bucket):
+    """
+    Counts times falling into consecutive buckets of given length
+    (in seconds), starting from midnight.
+    """
+    counts = [0] * ((24 * 3600 + bucket - 1) // bucket)
+    for moment in items:
+        counts[seconds_since_midnight(moment) // bucket] += 1
+    return counts
+
+
+@memorize(0, versioned=True)
+def mean_time_weekday(user_id):
+    """
+    Returns mean presence time of user grouped by weekday,
+    None if user does not exist.
+    """
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    return [
+        (calendar.day_abbr[weekday], mean(intervals))
+        for weekday, intervals in enumerate(group_by_weekday(items))
+    ]
+
+
+@memorize(0, versioned=True)
+def presence_weekday(user_id):
+    """
+    Returns total presence time of user grouped by weekday,
+    None if user does not exist.
+    """
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    result = [
+        (calendar.day_abbr[weekday], sum(intervals))
+        for weekday, intervals in enumerate(group_by_weekday(items))
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+@memorize(0, versioned=True)
+def presence_from_to(user_id):
+    """
+    Returns mean start and end times of user by weekday,
+    None if user does not exist.
+    """
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    return [
+        [calendar.day_abbr[day], int(value['start']), int(value['end'])]
+        for day, value in usual_presence_time(items).iteritems()
+    ]
+
+
+@memorize(0, versioned=True)
+def user_rollup(user_id, granularity):
+    """
+    Returns period buckets of given user, None if user does not exist.
+    For storages not kept in memory buckets are computed from user's data.
+    """
+    if not get_storage().in_memory:
+        items = get_user_data(user_id)
+        if not items:
+            return None
+        return user_buckets(items, granularity)
+    return get_rollups().get_user(user_id, granularity)
+
 
-    return years
+@memorize(0, versioned=True)
+def user_monthly_hours(user_id):
+    """
+    Returns hours worked by user in each month of every year,
+    None if user does not exist.
+    """
+    months = user_rollup(user_id, 'month')
+    if months is None:
+        return None
+    return monthly_hours_table(months)
+
+
+@memorize(0, versioned=True)
+def percentile_time_weekday(user_id, percent):
+    """
+    Returns given percentile of presence time of user grouped by weekday,
+    None if user does not exist.
+    """
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    return [
+        (calendar.day_abbr[weekday], percentile(intervals, percent))
+        for weekday, intervals in enumerate(group_by_weekday(items))
+    ]
 
 
-def _group_years_summary(years):
+@memorize(0, versioned=True)
+def percentile_presence_from_to(user_id, percent):
+    """
+    Returns given percentile of start and end times of user by weekday,
+    None if user does not exist.
     """
-    From given years dict, breaks each value list - seconds worked each day
-    into a list of months with worked hours.
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    weekdays = usual_presence_time(
+        items, statistic=lambda values: percentile(values, percent)
+    )
+    return [
+        [calendar.day_abbr[day], int(value['start']), int(value['end'])]
+        for day, value in weekdays.iteritems()
+    ]
+
+
+@memorize(0, versioned=True)
+def presence_histogram(user_id, bucket):
     """
-    result = {}
-    for month in range(1, 13):
-        for year, data in years.iteritems():
-            result.setdefault(year, [])
-            if data.get(month):
-                result[year].append(
-                    [
-                        calendar.month_abbr[month],
-                        sum(data.get(month)) / 60 ** 2
-                    ]
-                )
-            else:
-                result[year].append([calendar.month_abbr[month], 0])
+    Returns arrival and departure times histogram of user, compatible
+    with google charts api. None if user does not exist.
 
+    Structure sample (for 30 minutes long buckets):
+    [
+        ["Time", "Arrivals", "Departures"],
+        ["00:00", 0, 0],
+        ["00:30", 0, 0],
+        ...
+        ["23:30", 0, 1]
+    ]
+    """
+    items = get_user_data(user_id)
+    if not items:
+        return None
+    arrivals = histogram(
+        [times['start'] for times in items.itervalues()], bucket
+    )
+    departures = histogram(
+        [times['end'] for times in items.itervalues()], bucket
+    )
+    result = [['Time', 'Arrivals', 'Departures']]
+    for i, counts in enumerate(zip(arrivals, departures)):
+        seconds = i * bucket
+        result.append(
+            ['%02d:%02d' % (seconds // 3600, seconds // 60 % 60)] +
+            list(counts)
+        )
     return result
 
 
 def monthly_hours(items):
     """
-    Returns average working hours for each month in year,
+    Returns hours worked in each month of every year,
     compatible with google charts api.
 
     Structure sample:
@@ -212,14 +488,32 @@ def monthly_hours(items):
         ["Dec", 142, 149, 0]
     ]
     """
-    years = _get_years_and_months_total_hours(items)
-    result = _group_years_summary(years)
-    output = [['Year'] + map(str, years.iterkeys())]
+    return monthly_hours_table(user_buckets(items, 'month'))
 
-    for x in range(12):
-        item = [calendar.month_abbr[x+1]]
-        for lst in result.itervalues():
-            item.append(lst[x][1])
-        output.append(item)
 
-    return output
+def get_warmer():
+    """
+    Returns warmer of per-user API results cache.
+    """
+    warmer = app.extensions.get('cache_warmer')
+    if warmer is None:
+        warmer = app.extensions.setdefault(
+            'cache_warmer',
+            CacheWarmer(
+                [
+                    mean_time_weekday, presence_weekday, presence_from_to,
+                    user_monthly_hours,
+                ],
+                workers=app.config.get('WARMUP_WORKERS', 4),
+                top_n=app.config.get('WARMUP_TOP_N', 0),
+                retry_delay=app.config.get('WARMUP_RETRY_DELAY', 5.0),
+            )
+        )
+    return warmer
+
+
+def warm_up(version=None):
+    """
+    Starts cache warm-up of current dataset in background.
+    """
+    get_warmer().start(lambda: get_storage().user_ids())
@@ -2,23 +2,33 @@
 """
 Defines views.
 """
-import calendar
-import locale
 import logging
-from flask import redirect, url_for, make_response
-from flask.ext.mako import render_template
+import mimetypes
+import os
+from datetime import datetime
+from json import dumps
+from flask import (
+    redirect, url_for, make_response, request, Response, send_file
+)
+from flask_mako import MakoTemplates, render_template
 from mako.exceptions import TopLevelLookupException
-from lxml import etree
 
 from presence_analyzer.main import app
+from presence_analyzer.export import iter_rows, iter_packed, iter_csv
+from presence_analyzer.helpers import get_asset_sources
+from presence_analyzer.rollups import rollup_table
+from presence_analyzer.users import UsersRegistry
 from presence_analyzer.utils import (
-    jsonify, get_data, mean, group_by_weekday, usual_presence_time,
-    monthly_hours
+    jsonify, get_user_data, get_rollups, mean_time_weekday,
+    presence_weekday, presence_from_to, user_monthly_hours, user_rollup,
+    percentile_time_weekday, percentile_presence_from_to,
+    presence_histogram, get_anomalies, get_storage, get_warmer,
+    get_coalescer, memorize
 )
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-locale.setlocale(locale.LC_COLLATE, 'pl_PL')
+mako = MakoTemplates(app)  # pylint: disable=invalid-name
 
 
 def mainpage():
@@ -28,47 +38,127 @@ def mainpage():
     return redirect(url_for('render', template='presence_weekday'))
 
 
+@memorize(0, versioned=True)
+def get_users_registry():
+    """
+    Returns registry of users read from XML file, with sort keys and
+    search index computed once per file version.
+    """
+    try:
+        return UsersRegistry.from_xml(app.config['DATA_XML'])
+    except IOError:
+        log.error(
+            'No user data XML file found. '
+            'You can download it by running \"bin/update_xml\"'
+        )
+        return UsersRegistry([])
+
+
+def get_avatar_host():
+    """
+    Returns address of avatars server read from users XML file.
+    """
+    return get_users_registry().avatar_host
+
+
+def get_users():
+    """
+    Returns users read from XML file, sorted by name.
+    """
+    return get_users_registry().get_users()
+
+
+@memorize(0, versioned=True)
+def get_users_json():
+    """
+    Returns users listing serialized to JSON.
+    """
+    return dumps(get_users())
+
+
+def get_preloaded_json(template):
+    """
+    Returns JSON with data embedded in rendered page: users listing
+    and, if user is selected by `user_id` query parameter or
+    DEFAULT_USER_ID config option, data of the page's chart for that user.
+    """
+    page_views = {
+        'presence_weekday': presence_weekday_view,
+        'mean_time_weekday': mean_time_weekday_view,
+        'presence_start_end': presence_from_to_view,
+        'monthly_hours': monthly_hours_view,
+    }
+    if not app.config.get('PRELOAD_DATA', True):
+        return 'null'
+    user_id = request.args.get(
+        'user_id', app.config.get('DEFAULT_USER_ID'), type=int
+    )
+    data = 'null'
+    if user_id is not None and template in page_views:
+        data = page_views[template](user_id).data
+    preloaded = '{"users": %s, "user_id": %s, "data": %s}' % (
+        get_users_json(), dumps(user_id), data
+    )
+    # do not let data close the script element
+    return preloaded.replace('</', '<\\/')
+
+
 def render_page_user(template):
     """
     Renders template provided by user if it exists.
     """
-    tree = etree.parse(app.config['DATA_XML'])
-    xml_server = tree.getroot().find('server')
-    host = xml_server.find('host').text
-    port = xml_server.find('port').text
-    protocol = xml_server.find('protocol').text
-    template = ''.join([template, '.html'])
     try:
         return render_template(
-            template, avatar_host=''.join([protocol, '://', host, ':', port])
+            ''.join([template, '.html']),
+            avatar_host=get_avatar_host(),
+            preloaded_json=get_preloaded_json(template)
         )
     except TopLevelLookupException:
         return make_response("Requested template does not exist.", 404)
 
 
-@jsonify
+def asset_view(filename):
+    """
+    Serves fingerprinted static file with far-future caching headers.
+    Gzipped variant is sent if it has been built and client accepts it.
+    """
+    source = get_asset_sources().get(filename)
+    if source is None:
+        return make_response("Requested asset does not exist.", 404)
+
+    path = os.path.join(app.static_folder, source)
+    compressed = path + '.gz'
+    if ('gzip' in request.headers.get('Accept-Encoding', '') and
+            os.path.exists(compressed) and
+            os.path.getmtime(compressed) >= os.path.getmtime(path)):
+        response = send_file(
+            compressed, mimetype=mimetypes.guess_type(source)[0]
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % (
+        app.config.get('ASSET_MAX_AGE', 365 * 24 * 3600)
+    )
+    return response
+
+
 def users_view():
     """
-    Users listing for dropdown.
+    Users listing for dropdown, sorted by name, surname or id given as
+    `order` query parameter. Listing can be limited by `q` parameter to
+    users with name words starting with given words, for type-ahead.
     """
+    order = request.args.get('order', 'name')
+    query = request.args.get('q', '').strip()
+    if order == 'name' and not query:
+        return Response(get_users_json(), mimetype='application/json')
     try:
-        tree = etree.parse(app.config['DATA_XML'])
-        users_from_xml = tree.getroot().find('users')
-        xml_users = [
-            {
-                'user_id': int(user.get('id')),
-                'name': user.find('name').text,
-                'avatar': user.find('avatar').text
-            }
-            for user in users_from_xml
-        ]
-    except IOError:
-        log.error(
-            'No user data XML file found. '
-            'You can download it by running \"bin/update_xml\"'
-        )
-        xml_users = []
-    return sorted(xml_users, key=lambda k: k['name'], cmp=locale.strcoll)
+        users = get_users_registry().get_users(order, query)
+    except ValueError:
+        return make_response('Unknown users order.', 400)
+    return Response(dumps(users), mimetype='application/json')
 
 
 @jsonify
@@ -76,16 +166,25 @@ def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    get_warmer().record_request(user_id)
+    result = mean_time_weekday(user_id)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return 404
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    return result
+
+
+@jsonify
+def percentile_time_weekday_view(user_id, percent=50):
+    """
+    Returns given percentile (median by default) of presence time of given
+    user grouped by weekday.
+    """
+    result = percentile_time_weekday(user_id, percent)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        return 404
 
     return result
 
@@ -95,17 +194,12 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    get_warmer().record_request(user_id)
+    result = presence_weekday(user_id)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return 404
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
@@ -114,23 +208,149 @@ def presence_from_to_view(user_id):
     """
     Returns estimated time between working hours by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    get_warmer().record_request(user_id)
+    result = presence_from_to(user_id)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        return 404
+
+    return result
+
+
+@jsonify
+def percentile_from_to_view(user_id, percent=50):
+    """
+    Returns given percentile (median by default) of start and end times
+    by weekday.
+    """
+    result = percentile_presence_from_to(user_id, percent)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return 404
 
-    weekdays = usual_presence_time(data[user_id])
-    return [
-        [calendar.day_abbr[day], int(value['start']), int(value['end'])]
-        for day, value in weekdays.iteritems()
-    ]
+    return result
+
+
+def presence_histogram_view(user_id):
+    """
+    Returns histogram of arrival and departure times of given user.
+    Bucket length in minutes (up to a day) can be passed as `bucket` query
+    parameter.
+    """
+    try:
+        bucket = int(request.args.get('bucket', 30))
+    except ValueError:
+        bucket = None
+    if bucket is None or not 0 < bucket <= 24 * 60:
+        return make_response('Invalid histogram bucket.', 400)
+    result = presence_histogram(user_id, bucket * 60)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        result = 404
+
+    return Response(dumps(result), mimetype='application/json')
 
 
 @jsonify
 def monthly_hours_view(user_id):
-    data = get_data()
-    if user_id not in data:
+    """
+    Returns hours worked by given user in each month of every year.
+    """
+    get_warmer().record_request(user_id)
+    result = user_monthly_hours(user_id)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        return 404
+
+    return result
+
+
+@jsonify
+def rollup_view(granularity, user_id):
+    """
+    Returns presence totals, days and mean start/end times of given user
+    in every week, month or year.
+    """
+    buckets = user_rollup(user_id, granularity)
+    if buckets is None:
         log.debug('User %s not found!', user_id)
         return 404
 
-    return monthly_hours(data[user_id])
+    return rollup_table(buckets, granularity)
+
+
+@jsonify
+def company_rollup_view(granularity):
+    """
+    Returns presence totals, days and mean start/end times of the whole
+    company in every week, month or year.
+    """
+    return rollup_table(get_rollups().get_company(granularity), granularity)
+
+
+@jsonify
+def anomalies_view(user_id):
+    """
+    Returns anomaly counts and list of given user.
+    """
+    if not get_user_data(user_id):
+        log.debug('User %s not found!', user_id)
+        return 404
+
+    return get_anomalies().get_user(user_id)
+
+
+@jsonify
+def anomalies_summary_view():
+    """
+    Returns company-wide anomaly counts.
+    """
+    return get_anomalies().summary()
+
+
+@jsonify
+def coalescing_view():
+    """
+    Returns counters of coalesced computations and batched user loads.
+    """
+    return get_coalescer().stats()
+
+
+def health_view():
+    """
+    Readiness check for load balancer, successful once cache has been
+    warmed up.
+    """
+    if app.config.get('WARMUP', True) and not get_warmer().ready.is_set():
+        return make_response('Warming up.', 503)
+    return make_response('OK', 200)
+
+
+def export_view():
+    """
+    Streams presence data in packed columnar layout (format=packed,
+    default) or as CSV (format=csv). Data can be limited to users given
+    as comma separated `user_id` list and to `from`/`to` dates.
+    """
+    export_format = request.args.get('format', 'packed')
+    if export_format not in ('packed', 'csv'):
+        return make_response('Unknown export format.', 400)
+    try:
+        user_ids = request.args.get('user_id')
+        if user_ids is not None:
+            user_ids = [int(user_id) for user_id in user_ids.split(',')]
+        date_from, date_to = [
+            datetime.strptime(request.args[name], '%Y-%m-%d').date()
+            if name in request.args else None
+            for name in ('from', 'to')
+        ]
+    except ValueError:
+        return make_response('Invalid export parameters.', 400)
+
+    rows = iter_rows(get_storage(), user_ids, date_from, date_to)
+    chunk_rows = app.config.get('EXPORT_CHUNK_ROWS', 4096)
+    if export_format == 'csv':
+        return Response(iter_csv(rows, chunk_rows), mimetype='text/csv')
+    return Response(
+        iter_packed(rows, chunk_rows), mimetype='application/octet-stream'
+    )
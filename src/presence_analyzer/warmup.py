@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Cache warm-up of per-user API results.
+"""
+import logging
+import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, Thread
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _call(task):
+    """
+    Calls function with user id, used by pool workers.
+    """
+    function, user_id = task
+    function(user_id)
+
+
+class CacheWarmer(object):
+    """
+    Precomputes cached per-user results in a thread pool, for all users
+    or `top_n` most requested ones.
+
+    `ready` is set once the first warm-up has succeeded. Failed warm-up
+    is retried after `retry_delay` seconds.
+    """
+
+    def __init__(self, functions, workers=4, top_n=0, retry_delay=5.0):
+        self.functions = functions
+        self.workers = workers
+        self.top_n = top_n
+        self.retry_delay = retry_delay
+        self.requests = Counter()
+        self.ready = Event()
+        self.lock = Lock()
+        self.running = False
+        self.pending = False
+
+    def record_request(self, user_id):
+        """
+        Counts request for given user's data.
+        """
+        with self.lock:
+            self.requests[user_id] += 1
+
+    def select_users(self, user_ids):
+        """
+        Returns users to warm up, most requested first.
+        """
+        if not self.top_n or not self.requests:
+            return user_ids
+        known = set(user_ids)
+        with self.lock:
+            top = self.requests.most_common(self.top_n)
+        return [user_id for user_id, _ in top if user_id in known]
+
+    def run(self, user_ids):
+        """
+        Warms up cache of given users, logging progress.
+        """
+        started = time.time()
+        user_ids = self.select_users(list(user_ids))
+        tasks = [
+            (function, user_id)
+            for user_id in user_ids for function in self.functions
+        ]
+        log.info('Cache warm-up of %d users started', len(user_ids))
+        step = max(len(tasks) // 10, 1)
+        pool = ThreadPool(self.workers)
+        try:
+            for done, _ in enumerate(pool.imap_unordered(_call, tasks), 1):
+                if done % step == 0:
+                    log.info('Cache warm-up: %d/%d', done, len(tasks))
+        finally:
+            pool.close()
+            pool.join()
+        log.info(
+            'Cache warm-up of %d users finished in %.2fs',
+            len(user_ids), time.time() - started
+        )
+
+    def start(self, get_user_ids):
+        """
+        Runs warm-up in background thread. If warm-up is already running,
+        it is repeated once it finishes.
+        """
+        with self.lock:
+            if self.running:
+                self.pending = True
+                return
+            self.running = True
+        thread = Thread(
+            target=self._run, args=(get_user_ids,), name='cache-warmup'
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, get_user_ids):
+        """
+        Background warm-up loop.
+        """
+        while True:
+            try:
+                self.run(get_user_ids())
+            except Exception:  # pylint: disable=broad-except
+                log.exception(
+                    'Cache warm-up failed, retrying in %.1fs',
+                    self.retry_delay
+                )
+                time.sleep(self.retry_delay)
+                continue
+            self.ready.set()
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                self.pending = False
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Data source watcher publishing dataset version.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+from threading import Event, Lock, Thread
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of Linux inotify watching whole directories,
+    so files replaced by rename are noticed as well.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = set()
+
+    @classmethod
+    def create(cls):
+        """
+        Returns inotify instance, None if it is not supported.
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            return cls()
+        except (OSError, AttributeError):
+            log.info('inotify is not available, polling data sources')
+            return None
+
+    def watch(self, directory):
+        """
+        Starts watching given directory, if it is not watched yet.
+        """
+        if directory in self.directories:
+            return
+        if self.add_watch(self.fd, directory, WATCH_MASK) < 0:
+            log.warning('Cannot watch %s', directory)
+            return
+        self.directories.add(directory)
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for events, returns True if any
+        event has been received.
+        """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError:
+            pass
+        return True
+
+    def close(self):
+        """
+        Releases inotify file descriptor.
+        """
+        os.close(self.fd)
+
+
+class DataSourceWatcher(object):
+    """
+    Watches data source files and publishes monotonically increasing
+    dataset version, bumped every time any of the files changes.
+
+    Without running thread version is updated by synchronous check of
+    files' modification time and size. Watching thread waits for inotify
+    events (or polls on systems without inotify) and bumps version only
+    after files stay unchanged for `debounce` seconds, so burst writes
+    result in a single reload.
+    """
+
+    def __init__(self, get_paths, debounce=1.0, poll_interval=2.0):
+        self.get_paths = get_paths
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.signature = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.listeners = []
+
+    def current_signature(self):
+        """
+        Returns modification time and size of every data source file.
+        """
+        signature = []
+        for path in self.get_paths():
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                signature.append((path, None, None))
+            else:
+                signature.append((path, stat.st_mtime, stat.st_size))
+        return tuple(signature)
+
+    def check(self):
+        """
+        Bumps version and notifies listeners if data sources changed
+        since last check. Returns current version.
+        """
+        signature = self.current_signature()
+        with self.lock:
+            changed = signature != self.signature
+            if changed:
+                self.signature = signature
+                self.version += 1
+                log.info('Dataset version %d', self.version)
+            version = self.version
+        if changed:
+            for listener in self.listeners:
+                listener(version)
+        return version
+
+    @property
+    def running(self):
+        """
+        Tells if watching thread is running.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def get_version(self):
+        """
+        Returns current dataset version, checking data sources first
+        if watching thread is not running.
+        """
+        if self.running:
+            return self.version
+        return self.check()
+
+    def start(self):
+        """
+        Starts watching thread.
+        """
+        if self.running:
+            return
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name='data-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops watching thread.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """
+        Watching thread main loop.
+        """
+        inotify = Inotify.create()
+        self.check()
+        try:
+            while not self.stopped.is_set():
+                if inotify is not None:
+                    for path in self.get_paths():
+                        inotify.watch(os.path.dirname(os.path.abspath(path)))
+                    inotify.wait(self.poll_interval)
+                else:
+                    self.stopped.wait(self.poll_interval)
+                signature = self.current_signature()
+                if signature == self.signature:
+                    continue
+                # wait for writes to settle
+                while not self.stopped.wait(self.debounce):
+                    latest = self.current_signature()
+                    if latest == signature:
+                        break
+                    signature = latest
+                self.check()
+        finally:
+            if inotify is not None:
+                inotify.close()